@@ -0,0 +1,291 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from stashlib.logger import logger as log
+from stashlib.stash_interface import StashInterface
+from stashlib.stash_models import PerformersRow, StudiosRow, TagsRow
+from batch_writer import BatchWriter, ChangePlan, DEFAULT_BATCH_SIZE, scene_columns
+from lookup_index import LookupIndex, DEFAULT_NAME_MATCH_THRESHOLD
+from profiler import profiler as prof
+from scene_resolver import SceneResolver
+
+"""Processing mappings through the stash GraphQL api instead of the stash database
+"""
+
+DEFAULT_API_WORKERS = 4
+DEFAULT_API_RETRIES = 3
+DEFAULT_API_PAGE_SIZE = 1000
+# bulkSceneUpdate fields per mutation document
+DEFAULT_API_MUTATION_SIZE = 50
+
+FILE_FIELDS = 'path'
+# file names, sizes and fingerprints for matching moved files
+MATCH_FILE_FIELDS = 'path size fingerprints { type value }'
+
+def scenes_query(file_fields=FILE_FIELDS):
+    return f"""query($filter: FindFilterType) {{
+  findScenes(filter: $filter) {{
+    count
+    scenes {{
+      id
+      title
+      date
+      details
+      studio {{ id }}
+      tags {{ id }}
+      performers {{ id }}
+      files {{ {file_fields} }}
+    }}
+  }}
+}}"""
+
+def scene_path_query(file_fields=FILE_FIELDS):
+    return f"""query($scene_filter: SceneFilterType) {{
+  findScenes(scene_filter: $scene_filter) {{
+    count
+    scenes {{
+      id
+      title
+      date
+      details
+      studio {{ id }}
+      tags {{ id }}
+      performers {{ id }}
+      files {{ {file_fields} }}
+    }}
+  }}
+}}"""
+
+index_query = """query {
+  findPerformers(filter: {per_page: -1}) {
+    performers { id name disambiguation url alias_list }
+  }
+  findTags(filter: {per_page: -1}) {
+    tags { id name }
+  }
+  findStudios(filter: {per_page: -1}) {
+    studios { id name }
+  }
+}"""
+
+def call_with_retries(client: StashInterface, query, variables=None, retries=DEFAULT_API_RETRIES):
+    """callGraphQL, retrying failed requests with exponential backoff
+    """
+    for attempt in range(retries + 1):
+        try:
+            return client.callGraphQL(query, variables)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = 2 ** attempt
+            log.LogWarning(f"stash request failed, retrying in {delay}s: {e}")
+            prof.count('api_retries')
+            time.sleep(delay)
+
+def bulk_update_mutation(count):
+    """GraphQL document with count aliased bulkSceneUpdate fields u0..uN
+    """
+    params = ', '.join(f"$i{i}: BulkSceneUpdateInput!" for i in range(count))
+    fields = '\n'.join(f"  u{i}: bulkSceneUpdate(input: $i{i}) {{ id }}" for i in range(count))
+    return f"mutation({params}) {{\n{fields}\n}}"
+
+class ApiSceneResolver(SceneResolver):
+    """Maps file paths to scene ids from every scene read through the api in pages,
+    keeping the fields, tags and performers of each scene for ApiBatchWriter to diff against.
+    """
+
+    def __init__(self, client: StashInterface, workers=DEFAULT_API_WORKERS, page_size=DEFAULT_API_PAGE_SIZE, query_misses=False, path_rewrites=None, match_files=False):
+        self.client = client
+        self.workers = max(1, workers or 1)
+        self.page_size = page_size
+        self.scenes = {}
+        self.file_fields = MATCH_FILE_FIELDS if match_files else FILE_FIELDS
+        super().__init__(None, preload=True, query_misses=query_misses, path_rewrites=path_rewrites, match_files=match_files)
+
+    def _query(self, filepath):
+        variables = {'scene_filter': {'path': {'value': filepath, 'modifier': 'EQUALS'}}}
+        scenes = call_with_retries(self.client, scene_path_query(self.file_fields), variables)['findScenes']['scenes']
+        for scene in scenes:
+            self._add_scene(scene)
+        return [int(scene['id']) for scene in scenes]
+
+    def _page(self, page):
+        variables = {'filter': {'page': page, 'per_page': self.page_size, 'sort': 'id', 'direction': 'ASC'}}
+        return call_with_retries(self.client, scenes_query(self.file_fields), variables)['findScenes']
+
+    def _add_scene(self, scene):
+        scene_id = int(scene['id'])
+        self.scenes[scene_id] = {
+            'title': scene.get('title'),
+            'date': scene.get('date'),
+            'details': scene.get('details'),
+            'studio_id': int(scene['studio']['id']) if scene.get('studio') else None,
+            'tags': {int(tag['id']) for tag in scene.get('tags') or []},
+            'performers': {int(performer['id']) for performer in scene.get('performers') or []},
+        }
+        for file in scene.get('files') or []:
+            self.add(file['path'], scene_id)
+            if 'size' in file:
+                self.add_file(scene_id, file['path'], int(file['size']))
+            for fingerprint in file.get('fingerprints') or []:
+                self.add_fingerprint(scene_id, fingerprint['type'], fingerprint['value'])
+
+    def load_files(self):
+        # file names, sizes and fingerprints are read with the scenes
+        pass
+
+    def load(self):
+        first = self._page(1)
+        for scene in first['scenes']:
+            self._add_scene(scene)
+        pages = range(2, (first['count'] + self.page_size - 1) // self.page_size + 1)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result in executor.map(self._page, pages):
+                for scene in result['scenes']:
+                    self._add_scene(scene)
+        log.LogDebug(f"loaded {len(self.scenes)} scenes from stash")
+
+class ApiLookupIndex(LookupIndex):
+    """LookupIndex loaded through the api in a single request, creating tags with tagCreate
+    """
+
+    def __init__(self, client: StashInterface, name_match_threshold=DEFAULT_NAME_MATCH_THRESHOLD):
+        self.client = client
+        super().__init__(None, True, name_match_threshold)
+
+    def load(self):
+        result = call_with_retries(self.client, index_query)
+        performers = result['findPerformers']['performers']
+        for performer in performers:
+            self.add_performer(PerformersRow().from_dict({
+                'id': int(performer['id']),
+                'name': performer['name'],
+                'disambiguation': performer.get('disambiguation'),
+                'url': performer.get('url'),
+            }))
+        for performer in performers:
+            for alias in performer.get('alias_list') or []:
+                self.add_alias(performer['id'], alias)
+        for tag in result['findTags']['tags']:
+            self.add_tag(TagsRow().from_dict({'id': int(tag['id']), 'name': tag['name']}))
+        for studio in result['findStudios']['studios']:
+            self._studios_by_name[studio['name']] = StudiosRow().from_dict({'id': int(studio['id']), 'name': studio['name']})
+        log.LogDebug(f"loaded {len(self._performers_by_id)} performers, {len(self._tags_by_name)} tags, {len(self._studios_by_name)} studios")
+
+    def get_or_create_tag(self, name):
+        tag = self.tag_by_name(name)
+        if tag:
+            return tag
+        tag_id = self.client.createTagWithName(name)
+        if not tag_id:
+            raise Exception(f"failed to create tag {name}")
+        tag = TagsRow().from_dict({'id': int(tag_id), 'name': name})
+        log.LogInfo(f"created tag {name}")
+        self.add_tag(tag)
+        return tag
+
+class ApiBatchWriter(BatchWriter):
+    """BatchWriter that applies changes with bulkSceneUpdate mutations.
+    Scenes getting the same studio, tags and performers are updated together in one bulkSceneUpdate,
+    as are scenes getting the same title, date or details. Up to mutation_size updates are sent
+    in one request, up to workers requests at a time, each retried on failure.
+    """
+
+    def __init__(self, client: StashInterface, resolver: ApiSceneResolver, batch_size=DEFAULT_BATCH_SIZE, on_flush=None, plan: ChangePlan=None,
+            workers=DEFAULT_API_WORKERS, retries=DEFAULT_API_RETRIES, mutation_size=DEFAULT_API_MUTATION_SIZE):
+        super().__init__(None, batch_size, on_flush, plan)
+        self.client = client
+        self.resolver = resolver
+        self.workers = max(1, workers or 1)
+        self.retries = retries
+        self.mutation_size = max(1, mutation_size or 1)
+
+    def _read_current(self, scene_ids):
+        fields = {}
+        tags = set()
+        performers = set()
+        for scene_id in scene_ids:
+            scene = self.resolver.scenes.get(scene_id)
+            if not scene:
+                continue
+            fields[scene_id] = {column: scene[column] for column in scene_columns}
+            tags.update((scene_id, tag_id) for tag_id in scene['tags'])
+            performers.update((scene_id, performer_id) for performer_id in scene['performers'])
+        return fields, tags, performers
+
+    def _bulk_inputs(self, entries):
+        """Group the changes of entries into bulkSceneUpdate inputs, with the entry keys of each input
+        """
+        changes = {}
+
+        def change(scene_id, key):
+            if scene_id not in changes:
+                changes[scene_id] = {'fields': {}, 'tags': set(), 'performers': set(), 'keys': set()}
+            changes[scene_id]['keys'].add(key)
+            return changes[scene_id]
+
+        for entry in entries:
+            for column, value, scene_id in entry['scenes']:
+                change(scene_id, entry['key'])['fields'][column] = value
+            for scene_id, tag_id in entry['tags']:
+                change(scene_id, entry['key'])['tags'].add(tag_id)
+            for scene_id, performer_id in entry['performers']:
+                change(scene_id, entry['key'])['performers'].add(performer_id)
+
+        groups = {}
+        for scene_id, scene_change in changes.items():
+            fields = scene_change['fields']
+            links = (fields.get('studio_id'), tuple(sorted(scene_change['tags'])), tuple(sorted(scene_change['performers'])))
+            if links != (None, (), ()):
+                groups.setdefault(('links', links), []).append(scene_id)
+            values = tuple(sorted((column, value) for column, value in fields.items() if column != 'studio_id'))
+            if values:
+                groups.setdefault(('values', values), []).append(scene_id)
+
+        inputs = []
+        for (kind, group), scene_ids in groups.items():
+            bulk_input = {'ids': [str(scene_id) for scene_id in scene_ids]}
+            if kind == 'links':
+                studio_id, tag_ids, performer_ids = group
+                if studio_id is not None:
+                    bulk_input['studio_id'] = str(studio_id)
+                if tag_ids:
+                    bulk_input['tag_ids'] = {'ids': [str(tag_id) for tag_id in tag_ids], 'mode': 'ADD'}
+                if performer_ids:
+                    bulk_input['performer_ids'] = {'ids': [str(performer_id) for performer_id in performer_ids], 'mode': 'ADD'}
+            else:
+                bulk_input.update(group)
+            inputs.append((bulk_input, set().union(*(changes[scene_id]['keys'] for scene_id in scene_ids))))
+        return inputs, changes
+
+    def _send(self, inputs):
+        variables = {f"i{i}": bulk_input for i, (bulk_input, keys) in enumerate(inputs)}
+        try:
+            call_with_retries(self.client, bulk_update_mutation(len(inputs)), variables, self.retries)
+            return set()
+        except Exception as e:
+            failed = set().union(*(keys for bulk_input, keys in inputs))
+            log.LogError(f"failed to update {len(failed)} mapping entries: {e}")
+            return failed
+
+    def _write(self, entries):
+        inputs, changes = self._bulk_inputs(entries)
+        requests = [inputs[i:i + self.mutation_size] for i in range(0, len(inputs), self.mutation_size)]
+        failed = set()
+        with prof.latency('api batch'):
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for result in executor.map(self._send, requests):
+                    failed |= result
+        log.LogDebug(f"sent {len(inputs)} bulk scene updates for {len(entries)} mapping entries in {len(requests)} requests")
+
+        # keep the loaded scenes current so later batches diff against what was written
+        for scene_id, change in changes.items():
+            scene = self.resolver.scenes.get(scene_id)
+            if scene is None or change['keys'] & failed:
+                continue
+            scene.update(change['fields'])
+            scene['tags'] |= change['tags']
+            scene['performers'] |= change['performers']
+
+        self.entries_failed += len(failed)
+        self.entries_written += len(entries) - len(failed)
+        return [entry['key'] for entry in entries if entry['key'] in failed]
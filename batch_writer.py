@@ -0,0 +1,334 @@
+import json
+import sqlite3
+import time
+from stashlib.logger import logger as log
+from stashlib.stash_database import StashDatabase
+from profiler import profiler as prof
+from shared_database import SharedStashDatabase
+
+"""Batched writes of scene metadata to the stash database
+"""
+
+DEFAULT_BATCH_SIZE = 1000
+# scene ids per query when reading the current state of a batch, below sqlite's variable limit
+READ_CHUNK_SIZE = 500
+# entries applied between checks of how long the write transaction on a shared database has been open
+SHARED_WRITE_CHUNK_SIZE = 50
+
+scene_columns = ['title', 'date', 'details', 'studio_id']
+
+def column_value(value):
+    """Value as stored in the scenes table, dates are stored as YYYY-MM-DD text
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+class ChangePlan:
+    """Changes a run would make to stash, collected per mapping entry instead of being written
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def _entry(self, key):
+        if key not in self._entries:
+            self._entries[key] = {
+                'key': key,
+                'scenes': {},
+                'create_tags': [],
+                'create_performers': [],
+            }
+        return self._entries[key]
+
+    def _scene(self, key, scene_id):
+        scenes = self._entry(key)['scenes']
+        if scene_id not in scenes:
+            scenes[scene_id] = {
+                'scene_id': scene_id,
+                'set': {},
+                'add_tags': [],
+                'add_performers': [],
+            }
+        return scenes[scene_id]
+
+    def set_field(self, key, scene_id, column, old, new):
+        self._scene(key, scene_id)['set'][column] = {'from': old, 'to': new}
+
+    def add_tag(self, key, scene_id, tag_id):
+        self._scene(key, scene_id)['add_tags'].append(tag_id)
+
+    def add_performer(self, key, scene_id, performer_id):
+        self._scene(key, scene_id)['add_performers'].append(performer_id)
+
+    def create_tag(self, key, name):
+        entry = self._entry(key)
+        if name not in entry['create_tags']:
+            entry['create_tags'].append(name)
+
+    def create_performer(self, key, url):
+        entry = self._entry(key)
+        if url not in entry['create_performers']:
+            entry['create_performers'].append(url)
+
+    def entries(self):
+        return [dict(entry, scenes=list(entry['scenes'].values())) for entry in self._entries.values()]
+
+    def write(self, path):
+        """Save the plan as json, or log it if path is -
+        """
+        entries = self.entries()
+        if path != '-':
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, indent=2, default=str)
+            log.LogInfo(f"planned changes to {len(entries)} mapping entries written to {path}")
+            return
+        for entry in entries:
+            log.LogInfo(entry['key'])
+            for name in entry['create_tags']:
+                log.LogInfo(f"\tcreate tag {name}")
+            for url in entry['create_performers']:
+                log.LogInfo(f"\tcreate performer {url}")
+            for scene in entry['scenes']:
+                for column, change in scene['set'].items():
+                    log.LogInfo(f"\tscene {scene['scene_id']} {column}: {change['from']!r} -> {change['to']!r}")
+                for tag_id in scene['add_tags']:
+                    log.LogInfo(f"\tscene {scene['scene_id']} add tag {tag_id}")
+                for performer_id in scene['add_performers']:
+                    log.LogInfo(f"\tscene {scene['scene_id']} add performer {performer_id}")
+        log.LogInfo(f"planned changes to {len(entries)} mapping entries")
+
+class BatchWriter:
+    """Collects scene field updates, tag links and performer links for each mapping entry
+    and applies them to the database in large transactions.
+    Before each batch is written, the current fields and links of its scenes are read in bulk
+    and only values and links that differ are written.
+    If a batch fails, its entries are retried one at a time inside savepoints
+    so a single bad entry is rolled back without losing the rest of the batch.
+    With a SharedStashDatabase, a batch is committed every transaction_time seconds instead, so stash isn't kept waiting.
+    on_flush is called with the keys of the flushed entries and the keys that failed after each commit.
+    With a plan, the changes are added to the plan and nothing is written.
+    """
+
+    def __init__(self, db: StashDatabase, batch_size=DEFAULT_BATCH_SIZE, on_flush=None, plan: ChangePlan=None):
+        self.db = db
+        self.batch_size = max(1, batch_size or 1)
+        self.on_flush = on_flush
+        self.plan = plan
+        self.entries_written = 0
+        self.entries_failed = 0
+        self.changes = 0
+        self.unchanged = 0
+        # seconds spent waiting for stash's locks
+        self.lock_wait = 0.0
+        self._pending = []
+        self._entry = None
+
+    def begin_entry(self, key):
+        self._entry = {
+            'key': key,
+            'scenes': [],
+            'tags': [],
+            'performers': [],
+        }
+
+    def update_scene(self, scene_id, column, value):
+        if column not in scene_columns:
+            raise ValueError(f"unsupported scene column {column}")
+        self._entry['scenes'].append((column, column_value(value), scene_id))
+
+    def add_tag(self, scene_id, tag_id):
+        self._entry['tags'].append((scene_id, tag_id))
+
+    def add_performer(self, scene_id, performer_id):
+        self._entry['performers'].append((scene_id, int(performer_id)))
+
+    def end_entry(self):
+        entry = self._entry
+        self._entry = None
+        if entry:
+            self._pending.append(entry)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        with prof.phase('write_batches'):
+            self._flush()
+
+    def _flush(self):
+        keys = [entry['key'] for entry in self._pending]
+        entries = self._diff([entry for entry in self._pending if entry['scenes'] or entry['tags'] or entry['performers']])
+        self._pending = []
+        failed = []
+        if entries and not self.plan:
+            failed = self._write(entries)
+        if self.on_flush:
+            self.on_flush(keys, failed)
+
+    def _write(self, entries):
+        """Write the changes of entries in one transaction, returns the keys of entries that failed
+        """
+        if isinstance(self.db, SharedStashDatabase):
+            return self._write_shared(entries)
+        conn = self.db.conn
+        if not conn.in_transaction:
+            conn.execute('BEGIN')
+        failed = self._apply_batch(entries)
+        with prof.latency('db commit'):
+            conn.commit()
+        log.LogDebug(f"committed {len(entries)} mapping entries")
+        return failed
+
+    def _write_shared(self, entries):
+        """Write the changes of entries in transactions open for at most about transaction_time seconds
+        """
+        conn = self.db.conn
+        lock_wait = self.db.lock_wait
+        failed = []
+        commits = 0
+        started = time.perf_counter()
+        for i in range(0, len(entries), SHARED_WRITE_CHUNK_SIZE):
+            if not conn.in_transaction:
+                self.db.begin_write()
+                started = time.perf_counter()
+            failed += self._apply_batch(entries[i:i + SHARED_WRITE_CHUNK_SIZE])
+            if time.perf_counter() - started >= self.db.transaction_time:
+                self.db.commit()
+                commits += 1
+        if conn.in_transaction:
+            self.db.commit()
+            commits += 1
+        self.lock_wait += self.db.lock_wait - lock_wait
+        log.LogDebug(f"committed {len(entries)} mapping entries in {commits} transactions")
+        return failed
+
+    def _apply_batch(self, entries):
+        """Apply entries inside a savepoint, retrying them one at a time if that fails, returns the keys of entries that failed
+        """
+        conn = self.db.conn
+        failed = []
+        try:
+            conn.execute('SAVEPOINT mapping_batch')
+            self._apply(entries)
+            conn.execute('RELEASE SAVEPOINT mapping_batch')
+            self.entries_written += len(entries)
+        except sqlite3.Error as e:
+            conn.execute('ROLLBACK TO SAVEPOINT mapping_batch')
+            conn.execute('RELEASE SAVEPOINT mapping_batch')
+            log.LogWarning(f"batch write failed, retrying {len(entries)} entries individually: {e}")
+            for entry in entries:
+                if not self._apply_entry(entry):
+                    failed.append(entry['key'])
+        return failed
+
+    def close(self):
+        self.flush()
+
+    def _read_current(self, scene_ids):
+        """Current fields, tag links and performer links of scenes
+        """
+        conn = self.db.conn
+        fields = {}
+        tags = set()
+        performers = set()
+        scene_ids = list(scene_ids)
+        for i in range(0, len(scene_ids), READ_CHUNK_SIZE):
+            chunk = scene_ids[i:i + READ_CHUNK_SIZE]
+            params = ', '.join('?' * len(chunk))
+            for row in conn.execute(f"SELECT id, {', '.join(scene_columns)} FROM scenes WHERE id IN ({params})", chunk):
+                fields[row[0]] = dict(zip(scene_columns, row[1:]))
+            tags.update((row[0], row[1]) for row in conn.execute(f"SELECT scene_id, tag_id FROM scenes_tags WHERE scene_id IN ({params})", chunk))
+            performers.update((row[0], row[1]) for row in conn.execute(f"SELECT scene_id, performer_id FROM performers_scenes WHERE scene_id IN ({params})", chunk))
+        return fields, tags, performers
+
+    def _diff(self, entries):
+        """Drop updates and links the scenes already have, returns the entries that still have changes
+        """
+        if not entries:
+            return []
+        scene_ids = set()
+        for entry in entries:
+            scene_ids.update(scene_id for column, value, scene_id in entry['scenes'])
+            scene_ids.update(scene_id for scene_id, tag_id in entry['tags'])
+            scene_ids.update(scene_id for scene_id, performer_id in entry['performers'])
+        fields, tags, performers = self._read_current(scene_ids)
+
+        changes = self.changes
+        unchanged = self.unchanged
+        changed = []
+        for entry in entries:
+            key = entry['key']
+            # the last update of a field wins
+            updates = {}
+            for column, value, scene_id in entry['scenes']:
+                updates[(scene_id, column)] = value
+            scenes = []
+            for (scene_id, column), value in updates.items():
+                current = fields.get(scene_id)
+                if current is None or current[column] == value:
+                    continue
+                if self.plan:
+                    self.plan.set_field(key, scene_id, column, current[column], value)
+                current[column] = value
+                scenes.append((column, value, scene_id))
+            entry_tags = []
+            for link in entry['tags']:
+                if link[0] in fields and link not in tags:
+                    if self.plan:
+                        self.plan.add_tag(key, *link)
+                    tags.add(link)
+                    entry_tags.append(link)
+            entry_performers = []
+            for link in entry['performers']:
+                if link[0] in fields and link not in performers:
+                    if self.plan:
+                        self.plan.add_performer(key, *link)
+                    performers.add(link)
+                    entry_performers.append(link)
+
+            count = len(scenes) + len(entry_tags) + len(entry_performers)
+            self.changes += count
+            self.unchanged += len(entry['scenes']) + len(entry['tags']) + len(entry['performers']) - count
+            if count:
+                changed.append(dict(entry, scenes=scenes, tags=entry_tags, performers=entry_performers))
+        prof.count('scene_changes', self.changes - changes)
+        prof.count('unchanged_writes_skipped', self.unchanged - unchanged)
+        return changed
+
+    def _apply_entry(self, entry):
+        conn = self.db.conn
+        try:
+            conn.execute('SAVEPOINT mapping_entry')
+            self._apply([entry])
+            conn.execute('RELEASE SAVEPOINT mapping_entry')
+            self.entries_written += 1
+            return True
+        except sqlite3.Error as e:
+            conn.execute('ROLLBACK TO SAVEPOINT mapping_entry')
+            conn.execute('RELEASE SAVEPOINT mapping_entry')
+            self.entries_failed += 1
+            prof.count('entries_failed')
+            log.LogError(f"failed to update {entry['key']}: {e}")
+            return False
+
+    def _apply(self, entries):
+        conn = self.db.conn
+        scene_updates = {}
+        tags = []
+        performers = []
+        for entry in entries:
+            for column, value, scene_id in entry['scenes']:
+                scene_updates.setdefault(column, []).append((value, scene_id))
+            tags += entry['tags']
+            performers += entry['performers']
+
+        for column, rows in scene_updates.items():
+            conn.executemany(f"UPDATE scenes SET {column} = ? WHERE id = ?", rows)
+        if tags:
+            conn.executemany("""INSERT INTO scenes_tags (scene_id, tag_id)
+SELECT ?1, ?2 WHERE NOT EXISTS (SELECT 1 FROM scenes_tags WHERE scene_id = ?1 AND tag_id = ?2)""", tags)
+        if performers:
+            conn.executemany("""INSERT INTO performers_scenes (scene_id, performer_id)
+SELECT ?1, ?2 WHERE NOT EXISTS (SELECT 1 FROM performers_scenes WHERE scene_id = ?1 AND performer_id = ?2)""", performers)
@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from stashlib.logger import logger as log, LogLevel
+from stashlib.stash_database import StashDatabase
+from stashlib.stash_interface import StashInterface
+from benchmark_data import VIDEO_DIR, FakeStashServer, StashDatabaseLoad, create_stash_db, create_mapping, create_directory_tree, create_export_zip, create_performer_dirs, split_mapping
+from shared_database import SharedStashDatabase
+from mapper import generate_mapping_from_directory, generate_mapping_from_export_zip, process_mapping, process_mappings, map_directory_performers
+
+"""Benchmarks of generating and processing mappings against a synthetic stash database and a fake stash server
+"""
+
+BENCHMARKS = ['generate_mapping_from_directory', 'generate_mapping_from_export_zip', 'process_mapping', 'process_mapping_api', 'process_mapping_scrape_errors', 'process_mapping_relocated', 'process_mapping_moved', 'process_mapping_shared', 'process_mappings', 'map_directory_performers']
+DEFAULT_SCALES = [1000, 10000, 100000]
+DEFAULT_LATENCY = 0.005
+DEFAULT_THRESHOLD = 0.2
+# entries in each of the site mapping files of the process_mappings benchmark
+SITE_MAPPING_ENTRIES = 20
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def bench_generate_mapping_from_directory(workdir, scale, args):
+    dirpath = os.path.join(workdir, 'videos')
+    create_directory_tree(dirpath, scale)
+    mapfile = os.path.join(workdir, 'directory_mapping' + args.mapping_ext)
+    start = time.perf_counter()
+    generate_mapping_from_directory(dirpath, mapfile, performer_only=False, parse_filenames=True, recursive=True, workers=args.workers)
+    return time.perf_counter() - start, scale, None
+
+def bench_generate_mapping_from_export_zip(workdir, scale, args):
+    exportfile = os.path.join(workdir, 'export.zip')
+    create_export_zip(exportfile, scale)
+    mapfile = os.path.join(workdir, 'export_mapping' + args.mapping_ext)
+    start = time.perf_counter()
+    generate_mapping_from_export_zip(exportfile, mapfile, performer_only=False, parse_filenames=True, workers=args.workers)
+    return time.perf_counter() - start, scale, None
+
+def bench_process_mapping(workdir, scale, args):
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100))
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        db = StashDatabase(db_path, None, None)
+        start = time.perf_counter()
+        process_mapping(client, db, mapfile, os.path.join(workdir, 'mapping.out' + args.mapping_ext), create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0)
+        elapsed = time.perf_counter() - start
+        db.close()
+    return elapsed, scale, server.requests
+
+def bench_process_mapping_api(workdir, scale, args):
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100))
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        start = time.perf_counter()
+        process_mapping(client, None, mapfile, os.path.join(workdir, 'mapping.out' + args.mapping_ext), create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0)
+        elapsed = time.perf_counter() - start
+    return elapsed, scale, server.requests
+
+def bench_process_mapping_scrape_errors(workdir, scale, args):
+    # the scraper of one of the five performer sites fails, its performers must not be created without scraped data
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    # with names, a failed scrape could fall back to a performer with just the name and url
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100), missing_names=True)
+    failing_host = 'performers0.example.com'
+    with FakeStashServer(db_path, args.latency, failing_hosts=[failing_host]) as server:
+        client = StashInterface(None, server_url=server.url)
+        db = StashDatabase(db_path, None, None)
+        start = time.perf_counter()
+        process_mapping(client, db, mapfile, os.path.join(workdir, 'mapping.out' + args.mapping_ext), create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0,
+            journal_path=mapfile + '.journal')
+        elapsed = time.perf_counter() - start
+        created = db.fetchone("SELECT COUNT(*) FROM performers WHERE id > ? AND url LIKE ?", (performers, f"https://{failing_host}/%"))[0]
+        incomplete = sum(1 for line in open(mapfile + '.journal', encoding='utf-8') if '"status": "incomplete"' in line)
+        db.close()
+    if created:
+        raise Exception(f"created {created} performers whose scrape failed")
+    if not incomplete:
+        raise Exception("entries with performers whose scrape failed weren't left incomplete")
+    return elapsed, scale, server.requests, {'incomplete_entries': incomplete}
+
+def bench_process_mapping_relocated(workdir, scale, args):
+    # the library moved from the mount the mapping was generated on
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100), videos_dir='/mnt/old/videos')
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        db = StashDatabase(db_path, None, None)
+        start = time.perf_counter()
+        process_mapping(client, db, mapfile, os.path.join(workdir, 'mapping.out' + args.mapping_ext), create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0,
+            path_rewrites=[f"/mnt/old/videos={VIDEO_DIR}"], match_files=True)
+        elapsed = time.perf_counter() - start
+        db.close()
+    return elapsed, scale, server.requests
+
+def bench_process_mapping_moved(workdir, scale, args):
+    # the library moved and its old mount is gone, scenes are only found by the file names with the sizes and fingerprints in the mapping
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100), videos_dir='/mnt/gone/videos', file_fields=True)
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        db = StashDatabase(db_path, None, None)
+        start = time.perf_counter()
+        process_mapping(client, db, mapfile, os.path.join(workdir, 'mapping.out' + args.mapping_ext), create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0,
+            match_files=True)
+        elapsed = time.perf_counter() - start
+        updated = db.fetchone("SELECT COUNT(*) FROM scenes WHERE title LIKE 'Mapped Scene %'")[0]
+        db.close()
+    if updated != scale:
+        raise Exception(f"matched {updated} of {scale} moved scenes")
+    return elapsed, scale, server.requests
+
+def bench_process_mapping_shared(workdir, scale, args):
+    # another process reads and writes the database like a running stash server
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100))
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        db = SharedStashDatabase(db_path)
+        with StashDatabaseLoad(db_path) as stash:
+            start = time.perf_counter()
+            result = process_mapping(client, db, mapfile, os.path.join(workdir, 'mapping.out' + args.mapping_ext), create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0)
+            elapsed = time.perf_counter() - start
+        db.close()
+    return elapsed, scale, server.requests, dict(stash.summary(), lock_wait=result['lock_wait'])
+
+def bench_process_mappings(workdir, scale, args):
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    performers = max(10, scale // 10)
+    create_stash_db(db_path, scale, performers)
+    mapfile = os.path.join(workdir, 'mapping' + args.mapping_ext)
+    create_mapping(mapfile, scale, performers, missing_performers=max(1, scale // 100))
+    rootdir = os.path.join(workdir, 'sites')
+    split_mapping(mapfile, rootdir, SITE_MAPPING_ENTRIES)
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        db = StashDatabase(db_path, None, None)
+        start = time.perf_counter()
+        process_mappings(client, db, [rootdir], create_performers=True, update_stash=True, scrape_workers=args.scrape_workers, scrape_rate=0, journal=False)
+        elapsed = time.perf_counter() - start
+        db.close()
+    return elapsed, scale, server.requests
+
+def bench_map_directory_performers(workdir, scale, args):
+    # a library has about one performer for every ten scenes
+    performers = max(10, scale // 10)
+    db_path = os.path.join(workdir, 'stash-go.sqlite')
+    create_stash_db(db_path, 0, performers)
+    rootdir = os.path.join(workdir, 'performers')
+    create_performer_dirs(rootdir, performers)
+    with FakeStashServer(db_path, args.latency) as server:
+        client = StashInterface(None, server_url=server.url)
+        start = time.perf_counter()
+        map_directory_performers(client, rootdir, scrape_workers=args.scrape_workers, scrape_rate=0)
+        elapsed = time.perf_counter() - start
+    return elapsed, performers, server.requests
+
+def run_benchmark(name, scale, args):
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f"{name}-{scale}-", dir=args.workdir)
+    try:
+        elapsed, entries, requests, *extra = globals()['bench_' + name](workdir, scale, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    result = {
+        'benchmark': name,
+        'scale': scale,
+        'entries': entries,
+        'seconds': round(elapsed, 4),
+        'entries_per_second': round(entries / max(elapsed, 1e-9), 1),
+    }
+    if requests is not None:
+        result['requests'] = requests
+    # measurements beyond the run time, i.e. how long stash waited on the database
+    for measurements in extra:
+        result.update(measurements)
+    return result
+
+def compare_results(results, baseline, threshold):
+    """Returns the results that are slower than the same benchmark and scale in the baseline by more than threshold
+    """
+    previous = {(r['benchmark'], r['scale']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['benchmark'], result['scale']))
+        if not before:
+            continue
+        change = result['seconds'] / max(before['seconds'], 1e-9) - 1
+        print(f"{result['benchmark']:<36}{result['scale']:>8}{before['seconds']:>12.3f}s{result['seconds']:>12.3f}s{change:>+10.1%}")
+        if change > threshold:
+            regressions.append(result)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark generating and processing mapping files with a synthetic stash database and server.')
+    parser.add_argument('--scales', type=str, default=','.join(str(scale) for scale in DEFAULT_SCALES), help='comma separated numbers of scenes to benchmark')
+    parser.add_argument('--benchmarks', type=str, default=','.join(BENCHMARKS), help='comma separated benchmarks to run')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help='seconds the fake stash server waits before answering each request')
+    parser.add_argument('--workers', type=int, help='number of workers used to read exports, scan directories and parse filenames')
+    parser.add_argument('--scrape_workers', type=int, default=4, help='number of performer urls scraped concurrently')
+    parser.add_argument('--mapping_ext', type=str, default='.yaml', choices=['.yaml', '.jsonl', '.msgpack'], help='extension, and so format, of the generated and processed mapping files')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='json results file')
+    parser.add_argument('--compare', type=str, help='json results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='fraction a benchmark can be slower than the compared run before it counts as a regression')
+    parser.add_argument('--workdir', type=str, help='directory for generated databases and files (default: system temp directory)')
+    parser.add_argument('--keep', action='store_true', help="don't delete generated databases and files")
+    parser.add_argument('--log_level', type=int, default=4, choices=range(1, 6), help="log levels: 1=trace, 2=debug, 3=info, 4=warn, 5=error")
+    args = parser.parse_args()
+
+    log.plugin = False
+    log.log_level = LogLevel(args.log_level)
+
+    benchmarks = [name.strip() for name in args.benchmarks.split(',') if name.strip()]
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}, choose from {', '.join(BENCHMARKS)}")
+    scales = [int(scale) for scale in args.scales.split(',') if scale.strip()]
+
+    results = []
+    for scale in scales:
+        for name in benchmarks:
+            result = run_benchmark(name, scale, args)
+            print(f"{name:<36}{scale:>8}{result['seconds']:>12.3f}s{result['entries_per_second']:>12.1f}/s")
+            results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'latency': args.latency,
+        'workers': args.workers,
+        'scrape_workers': args.scrape_workers,
+        'mapping_ext': args.mapping_ext,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"compared to {args.compare} ({baseline.get('commit')})")
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+            raise SystemExit(1)
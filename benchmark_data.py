@@ -0,0 +1,393 @@
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from stashlib.stash_database import StashDatabase
+from profiler import Histogram
+from mapping_io import iter_mapping, MappingWriter
+
+"""Synthetic stash databases, mappings, directories, exports and a stand-in stash GraphQL server for benchmarks
+"""
+
+SCHEMA = """
+CREATE TABLE schema_migrations (version uint64 not null, dirty bool not null);
+CREATE TABLE folders (id integer not null primary key autoincrement, path varchar(255) not null, parent_folder_id integer, mod_time datetime not null default 0, created_at datetime not null default 0, updated_at datetime not null default 0, zip_file_id integer);
+CREATE UNIQUE INDEX index_folders_on_path_unique ON folders (path);
+CREATE TABLE files (id integer not null primary key autoincrement, basename varchar(255) not null, zip_file_id integer, parent_folder_id integer not null, size integer not null, mod_time datetime not null default 0, created_at datetime not null default 0, updated_at datetime not null default 0);
+CREATE UNIQUE INDEX index_files_zip_basename_unique ON files (zip_file_id, parent_folder_id, basename);
+CREATE INDEX index_files_on_parent_folder_id_basename ON files (parent_folder_id, basename);
+CREATE TABLE files_fingerprints (file_id integer not null, type varchar(255) not null, fingerprint blob not null, PRIMARY KEY (file_id, type, fingerprint));
+CREATE INDEX index_fingerprint_type_fingerprint ON files_fingerprints (type, fingerprint);
+CREATE TABLE scenes (id integer not null primary key autoincrement, title varchar(255), details text, date date, rating tinyint, studio_id integer, o_counter tinyint not null default 0, organized boolean not null default '0', created_at datetime not null default 0, updated_at datetime not null default 0, code text, director text, resume_time float not null default 0, last_played_at datetime default null, play_count tinyint not null default 0, play_duration float not null default 0, cover_blob varchar(255));
+CREATE TABLE scenes_files (scene_id integer not null, file_id integer not null, "primary" boolean not null, PRIMARY KEY(scene_id, file_id));
+CREATE INDEX index_scenes_files_file_id ON scenes_files (file_id);
+CREATE TABLE performers (id integer not null primary key autoincrement, name varchar(255) not null, disambiguation varchar(255), gender varchar(20), url varchar(255), twitter varchar(255), instagram varchar(255), birthdate date, ethnicity varchar(255), country varchar(255), eye_color varchar(255), height int, measurements varchar(255), fake_tits varchar(255), career_length varchar(255), tattoos varchar(255), piercings varchar(255), favorite boolean not null default '0', created_at datetime not null default 0, updated_at datetime not null default 0, details text, death_date date, hair_color varchar(255), weight integer, rating tinyint, ignore_auto_tag boolean not null default '0', image_blob varchar(255), penis_length float, circumcised varchar[10]);
+CREATE INDEX index_performers_on_name ON performers (name);
+CREATE TABLE performer_aliases (performer_id integer not null, alias varchar(255) not null, PRIMARY KEY(performer_id, alias));
+CREATE TABLE tags (id integer not null primary key autoincrement, name varchar(255) not null, created_at datetime not null default 0, updated_at datetime not null default 0, ignore_auto_tag boolean not null default '0', description text, image_blob varchar(255));
+CREATE UNIQUE INDEX index_tags_on_name ON tags (name);
+CREATE TABLE studios (id integer not null primary key autoincrement, name varchar(255) not null, url varchar(255), parent_id integer default null, created_at datetime not null default 0, updated_at datetime not null default 0, details text, rating tinyint, ignore_auto_tag boolean not null default '0', image_blob varchar(255));
+CREATE UNIQUE INDEX index_studios_on_name_unique ON studios (name);
+CREATE TABLE scenes_tags (scene_id integer not null, tag_id integer not null, PRIMARY KEY(scene_id, tag_id));
+CREATE TABLE performers_scenes (performer_id integer not null, scene_id integer not null, PRIMARY KEY(scene_id, performer_id));
+"""
+
+VIDEO_DIR = '/library/videos'
+
+def scene_filepath(i):
+    return f"{VIDEO_DIR}/site{i % 20}/[Studio{i % 50}] Performer {i % 1000} - Scene {i} (2021.10.{i % 28 + 1:02}).mp4"
+
+def performer_url(i):
+    return f"https://performers{i % 5}.example.com/performer/{i}"
+
+def create_stash_db(db_path, scenes, performers, tags=100, studios=50):
+    """Create a stash database with the given number of scenes, performers, tags and studios.
+    Scene files live under VIDEO_DIR, performers with an even id have a url.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    conn.execute("INSERT INTO schema_migrations (version, dirty) VALUES (?, 0)", (StashDatabase.SCHEMA_VERSION, ))
+    folders = {}
+    for i in range(scenes):
+        dirpath = os.path.dirname(scene_filepath(i))
+        if dirpath not in folders:
+            folders[dirpath] = conn.execute("INSERT INTO folders (path) VALUES (?)", (dirpath, )).lastrowid
+    conn.executemany("INSERT INTO files (id, basename, parent_folder_id, size) VALUES (?, ?, ?, ?)",
+        ((i + 1, os.path.basename(scene_filepath(i)), folders[os.path.dirname(scene_filepath(i))], 1000000 + i) for i in range(scenes)))
+    conn.executemany("INSERT INTO files_fingerprints (file_id, type, fingerprint) VALUES (?, 'oshash', ?)",
+        ((i + 1, f"{i:016x}") for i in range(scenes)))
+    conn.executemany("INSERT INTO scenes (id, title) VALUES (?, ?)", ((i + 1, f"Scene {i}") for i in range(scenes)))
+    conn.executemany("INSERT INTO scenes_files (scene_id, file_id, \"primary\") VALUES (?, ?, 1)", ((i + 1, i + 1) for i in range(scenes)))
+    conn.executemany("INSERT INTO performers (id, name, url) VALUES (?, ?, ?)",
+        ((i + 1, f"Performer {i}", performer_url(i) if i % 2 == 0 else None) for i in range(performers)))
+    conn.executemany("INSERT INTO performer_aliases (performer_id, alias) VALUES (?, ?)",
+        ((i + 1, f"Alias {i}") for i in range(0, performers, 3)))
+    conn.executemany("INSERT INTO tags (id, name) VALUES (?, ?)", ((i + 1, f"Tag {i}") for i in range(tags)))
+    conn.executemany("INSERT INTO studios (id, name) VALUES (?, ?)", ((i + 1, f"Studio{i}") for i in range(studios)))
+    conn.commit()
+    conn.close()
+
+def create_mapping(mapfile, scenes, performers, missing_performers=0, videos_dir=VIDEO_DIR, missing_names=False, file_fields=False):
+    """Create a full mapping of every scene file with title, date, studio, tags and two performers.
+    missing_performers is the number of distinct performer urls that aren't in the database, with missing_names they also have a name.
+    With videos_dir, the scene files are mapped under videos_dir instead of where the database has them.
+    With file_fields, entries record the file size like generated mappings, every tenth the oshash instead.
+    """
+    with MappingWriter(mapfile) as writer:
+        for i in range(scenes):
+            actors = [{'name': '', 'disambiguation': '', 'url': performer_url((i * 2) % max(performers, 1))}]
+            if missing_performers:
+                missing = performers + i % missing_performers
+                actors.append({'name': f"Performer {missing}" if missing_names else '', 'disambiguation': '', 'url': performer_url(missing)})
+            else:
+                actors.append({'name': f"Performer {(i * 2 + 1) % max(performers, 1)}", 'disambiguation': '', 'url': ''})
+            entry = {
+                'title': f"Mapped Scene {i}",
+                'date': f"2021-10-{i % 28 + 1:02}",
+                'details': '',
+                'studio': f"Studio{i % 50}",
+                'tags': [f"Tag {i % 100}", f"Tag {(i + 1) % 100}"],
+                'url': '',
+                'performers': actors,
+            }
+            if file_fields and i % 10 == 5:
+                entry['oshash'] = f"{i:016x}"
+            elif file_fields:
+                entry['size'] = 1000000 + i
+            writer.write(videos_dir + scene_filepath(i)[len(VIDEO_DIR):], entry)
+
+def create_directory_tree(rootdir, files, dirs=20):
+    for i in range(files):
+        dirpath = os.path.join(rootdir, f"site{i % dirs}")
+        os.makedirs(dirpath, exist_ok=True)
+        open(os.path.join(dirpath, os.path.basename(scene_filepath(i))), 'w').close()
+
+def create_export_zip(exportfile, scenes):
+    with zipfile.ZipFile(exportfile, 'w') as archive:
+        for i in range(scenes):
+            archive.writestr(f"scenes/{i}.json", json.dumps({
+                'title': f"Scene {i}",
+                'details': 'x' * 200,
+                'files': [scene_filepath(i)],
+                'created_at': '2021-10-11T00:00:00Z',
+            }))
+            archive.writestr(f"files/{i}.json", json.dumps({
+                'path': scene_filepath(i),
+                'size': 1000000 + i,
+                'fingerprints': [{'type': 'oshash', 'fingerprint': f"{i:016x}"}, {'type': 'phash', 'fingerprint': -i - 1}],
+                'mod_time': '2021-10-11T00:00:00Z',
+            }))
+
+def create_performer_dirs(rootdir, performers):
+    """Create a performer root directory with a mapping of performer directories to names and urls.
+    Performers with an even id have their url in the database, the others are created from their url.
+    """
+    with MappingWriter(os.path.join(rootdir, 'mapping.yaml')) as writer:
+        for i in range(performers):
+            dirpath = os.path.join(rootdir, f"Performer {i}")
+            os.makedirs(dirpath, exist_ok=True)
+            writer.write(dirpath, [{'name': f"Performer {i}", 'disambiguation': '', 'url': performer_url(i)}])
+
+def split_mapping(mapfile, rootdir, entries_per_file):
+    """Split a mapping into site directories under rootdir, each with a mapping of entries_per_file entries
+    in the format of mapfile. Returns the number of mapping files.
+    """
+    ext = os.path.splitext(mapfile)[1]
+    writer = None
+    files = 0
+    for i, (key, value) in enumerate(iter_mapping(mapfile)):
+        if i % entries_per_file == 0:
+            if writer:
+                writer.close()
+            writer = MappingWriter(os.path.join(rootdir, f"site{files}", 'mapping' + ext))
+            files += 1
+        writer.write(key, value)
+    if writer:
+        writer.close()
+    return files
+
+def _use_like_stash(db_path, hold, interval, stop, results):
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    reads = []
+    writes = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        conn.execute("SELECT COUNT(*) FROM scenes_tags").fetchone()
+        reads.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        writes.append(time.perf_counter() - start)
+        conn.execute("UPDATE scenes SET updated_at = CURRENT_TIMESTAMP WHERE id = 1")
+        time.sleep(hold)
+        conn.execute('COMMIT')
+        stop.wait(interval)
+    conn.close()
+    results.put((reads, writes))
+
+class StashDatabaseLoad:
+    """A second process using a stash database like a running stash server, reading and then taking
+    the write lock for hold seconds every interval seconds. Records how long its reads took
+    and how long it waited for the write lock, so the mapper's effect on stash can be measured.
+    """
+
+    def __init__(self, db_path, hold=0.05, interval=0.1):
+        self.db_path = db_path
+        self.hold = hold
+        self.interval = interval
+        self.reads = Histogram()
+        self.writes = Histogram()
+        self._stop = multiprocessing.Event()
+        self._results = multiprocessing.Queue()
+        self._process = None
+
+    def start(self):
+        self._process = multiprocessing.Process(target=_use_like_stash, args=(self.db_path, self.hold, self.interval, self._stop, self._results), daemon=True)
+        self._process.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        reads, writes = self._results.get()
+        self._process.join()
+        for seconds in reads:
+            self.reads.add(seconds * 1000)
+        for seconds in writes:
+            self.writes.add(seconds * 1000)
+
+    def summary(self):
+        return {'stash_reads': self.reads.summary(), 'stash_write_lock_waits': self.writes.summary()}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+class FakeStashServer:
+    """Local stand-in for the stash GraphQL endpoint backed by a synthetic stash database.
+    Answers scrapePerformerURL, performerCreate, findPerformers, findScenes, findTags, findStudios, tagCreate
+    and bulkSceneUpdate with a configurable latency per request and counts requests by operation.
+    Scrapes of urls on failing_hosts answer with an error, like a scraper whose site is down.
+    """
+
+    def __init__(self, db_path, latency=0.0, host='127.0.0.1', port=0, failing_hosts=()):
+        self.db_path = db_path
+        self.latency = latency
+        self.failing_hosts = set(failing_hosts)
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                result = server.handle(body.get('query', ''), body.get('variables') or {})
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://{host}:{self._httpd.server_address[1]}/graphql"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._conn.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _count(self, operation):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def _performer(self, row):
+        aliases = [r[0] for r in self._conn.execute("SELECT alias FROM performer_aliases WHERE performer_id = ?", (row['id'], ))]
+        return {'id': str(row['id']), 'name': row['name'], 'disambiguation': row['disambiguation'] or '', 'url': row['url'], 'alias_list': aliases}
+
+    def _find_performers(self, find_filter, performer_filter):
+        self._count('findPerformers lookups')
+        url_filter = (performer_filter or {}).get('url')
+        with self._lock:
+            if url_filter:
+                rows = self._conn.execute("SELECT * FROM performers WHERE url = ?", (url_filter['value'], )).fetchall()
+            else:
+                q = (find_filter or {}).get('q', '')
+                rows = self._conn.execute("SELECT * FROM performers WHERE name LIKE ? LIMIT 100", (f"%{q}%", )).fetchall()
+        performers = [self._performer(row) for row in rows]
+        return {'count': len(performers), 'performers': performers}
+
+    def _find_scenes(self, find_filter, scene_filter=None):
+        page = find_filter.get('page', 1)
+        per_page = find_filter.get('per_page', 25)
+        path_filter = (scene_filter or {}).get('path')
+        with self._lock:
+            if path_filter:
+                dirpath, basename = os.path.split(path_filter['value'])
+                rows = self._conn.execute("""SELECT a.* FROM scenes a JOIN scenes_files b ON a.id = b.scene_id
+JOIN files c ON c.id = b.file_id JOIN folders d ON d.id = c.parent_folder_id WHERE d.path = ? AND c.basename = ?""", (dirpath, basename)).fetchall()
+                count = len(rows)
+            else:
+                count = self._conn.execute("SELECT COUNT(*) FROM scenes").fetchone()[0]
+                rows = self._conn.execute("SELECT * FROM scenes ORDER BY id LIMIT ? OFFSET ?", (per_page, (page - 1) * per_page)).fetchall()
+            scenes = []
+            for row in rows:
+                scene_id = row['id']
+                scenes.append({
+                    'id': str(scene_id),
+                    'title': row['title'],
+                    'date': row['date'],
+                    'details': row['details'],
+                    'studio': {'id': str(row['studio_id'])} if row['studio_id'] else None,
+                    'tags': [{'id': str(r[0])} for r in self._conn.execute("SELECT tag_id FROM scenes_tags WHERE scene_id = ?", (scene_id, ))],
+                    'performers': [{'id': str(r[0])} for r in self._conn.execute("SELECT performer_id FROM performers_scenes WHERE scene_id = ?", (scene_id, ))],
+                    'files': [{
+                        'path': r[0] + '/' + r[1],
+                        'size': r[2],
+                        'fingerprints': [{'type': f[0], 'value': f[1] if f[0] != 'phash' else f"{f[1] & 0xFFFFFFFFFFFFFFFF:x}"}
+                            for f in self._conn.execute("SELECT type, fingerprint FROM files_fingerprints WHERE file_id = ?", (r[3], ))],
+                    } for r in self._conn.execute("""SELECT d.path, c.basename, c.size, c.id FROM scenes_files b
+JOIN files c ON c.id = b.file_id JOIN folders d ON d.id = c.parent_folder_id WHERE b.scene_id = ?""", (scene_id, ))],
+                })
+        return {'count': count, 'scenes': scenes}
+
+    def _bulk_scene_update(self, bulk_input):
+        self._count('bulkSceneUpdate updates')
+        ids = [int(scene_id) for scene_id in bulk_input['ids']]
+        with self._lock:
+            for column in ('title', 'date', 'details', 'studio_id'):
+                if column in bulk_input:
+                    self._conn.executemany(f"UPDATE scenes SET {column} = ? WHERE id = ?", ((bulk_input[column], scene_id) for scene_id in ids))
+            for field, table, column in (('tag_ids', 'scenes_tags', 'tag_id'), ('performer_ids', 'performers_scenes', 'performer_id')):
+                if field in bulk_input:
+                    self._conn.executemany(f"INSERT OR IGNORE INTO {table} (scene_id, {column}) VALUES (?, ?)",
+                        ((scene_id, int(link_id)) for scene_id in ids for link_id in bulk_input[field]['ids']))
+            self._conn.commit()
+        return [{'id': str(scene_id)} for scene_id in ids]
+
+    def handle(self, query, variables):
+        if self.latency:
+            time.sleep(self.latency)
+        if 'bulkSceneUpdate' in query:
+            self._count('bulkSceneUpdate')
+            aliases = re.findall(r'(\w+):\s*bulkSceneUpdate\(input:\s*\$(\w+)\)', query)
+            return {'data': {alias: self._bulk_scene_update(variables[var]) for alias, var in aliases}}
+        if 'findScenes' in query:
+            self._count('findScenes')
+            return {'data': {'findScenes': self._find_scenes(variables.get('filter') or {}, variables.get('scene_filter'))}}
+        if 'findTags' in query:
+            # performers, tags and studios in one request
+            self._count('findTags')
+            with self._lock:
+                performers = [self._performer(row) for row in self._conn.execute("SELECT * FROM performers")]
+                tags = [{'id': str(row['id']), 'name': row['name']} for row in self._conn.execute("SELECT id, name FROM tags")]
+                studios = [{'id': str(row['id']), 'name': row['name']} for row in self._conn.execute("SELECT id, name FROM studios")]
+            return {'data': {'findPerformers': {'performers': performers}, 'findTags': {'tags': tags}, 'findStudios': {'studios': studios}}}
+        if 'tagCreate' in query:
+            self._count('tagCreate')
+            with self._lock:
+                c = self._conn.execute("INSERT INTO tags (name) VALUES (?)", (variables['input']['name'], ))
+                self._conn.commit()
+            return {'data': {'tagCreate': {'id': str(c.lastrowid)}}}
+        if 'scrapePerformerURL' in query:
+            self._count('scrapePerformerURL')
+            url = variables['url']
+            if urlparse(url).netloc in self.failing_hosts:
+                return {'errors': [{'message': f"scraper failed for {url}"}]}
+            return {'data': {'scrapePerformerURL': {
+                'name': 'Scraped ' + url.rstrip('/').split('/')[-1],
+                'url': url,
+                'gender': 'female',
+                'birthdate': '1990-01-01',
+                'death_date': None,
+                'country': 'US',
+                'aliases': '',
+                'height': '170',
+                'images': [],
+                'details': 'scraped',
+                'tags': [],
+            }}}
+        if 'performerCreate' in query:
+            self._count('performerCreate')
+            data = variables.get('input') or {'name': variables.get('name')}
+            with self._lock:
+                c = self._conn.execute("INSERT INTO performers (name, url, gender, details) VALUES (?, ?, ?, ?)",
+                    (data['name'], data.get('url'), data.get('gender'), data.get('details')))
+                self._conn.commit()
+            return {'data': {'performerCreate': {'id': str(c.lastrowid)}}}
+        if 'findPerformers' in query:
+            self._count('findPerformers')
+            # batched lookups alias one findPerformers field per lookup, each with its own filter variables
+            aliases = re.findall(r'(\w+):\s*findPerformers\(filter:\s*\$(\w+),\s*performer_filter:\s*\$(\w+)\)', query)
+            if not aliases:
+                return {'data': {'findPerformers': self._find_performers(variables.get('filter'), variables.get('performer_filter'))}}
+            return {'data': {alias: self._find_performers(variables.get(filter_var), variables.get(performer_filter_var))
+                for alias, filter_var, performer_filter_var in aliases}}
+        self._count('unknown')
+        return {'errors': [{'message': 'unsupported query'}]}
@@ -5,7 +5,18 @@ import sys
 from stashlib.logger import logger as log, LogLevel
 from stashlib.stash_database import StashDatabase
 from stashlib.stash_interface import StashInterface
-from mapper import generate_mapping_from_directory, generate_mapping_from_export_zip, generate_mapping_from_export_dir, process_mapping
+from api_backend import DEFAULT_API_WORKERS
+from batch_writer import DEFAULT_BATCH_SIZE
+from lookup_index import DEFAULT_NAME_MATCH_THRESHOLD
+from mapping_io import convert_mapping
+from scanner import DEFAULT_EXCLUDE_EXTS
+from scene_resolver import parse_path_rewrite
+from shared_database import SharedStashDatabase, DEFAULT_BUSY_TIMEOUT, DEFAULT_TRANSACTION_TIME
+from scrape_cache import ScrapeCache, DEFAULT_CACHE_TTL_DAYS
+from scraper import DEFAULT_SCRAPE_WORKERS, DEFAULT_SCRAPE_RATE
+from watcher import DEFAULT_POLL_INTERVAL, DEFAULT_DEBOUNCE
+from profiler import profiler as prof
+from mapper import generate_mapping_from_directory, generate_mapping_from_export_zip, generate_mapping_from_export_dir, process_mapping, process_mappings, watch_directories
 
 def dir_path(path):
     if os.path.isdir(path):
@@ -13,6 +24,13 @@ def dir_path(path):
     else:
         raise argparse.ArgumentTypeError(f"{path} is not a valid path")
 
+def path_rewrite(rule):
+    try:
+        parse_path_rewrite(rule)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return rule
+
 def file_path(path):
     if os.path.isfile(path):
         return path
@@ -23,49 +41,106 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate and process yaml mapping files.')
     parser.add_argument('-d', '--directory', type=dir_path, help='directory to generate a yaml mapping file from')
     parser.add_argument('-p', '--process', type=file_path, help='input yaml file')
+    parser.add_argument('-b', '--batch', type=str, nargs='+', help='mapping files, or directories to search for mapping files, to process in one run')
+    parser.add_argument('--batch_report', type=str, help='json file to save the results of each mapping file processed with --batch')
     parser.add_argument('-o', '--output', type=str, help='output yaml file')
+    parser.add_argument('--convert', type=file_path, help='mapping file to convert to the format of the --output file extension (.yaml, .jsonl or .msgpack)')
     parser.add_argument('--input_zip', type=file_path, help='stash export zip file of stash scenes to generate a yaml mapping file from')
-    parser.add_argument('--input_dir', type=file_path, help='stash export directory of stash scenes to generate a yaml mapping file from')
+    parser.add_argument('-w', '--watch', type=dir_path, nargs='+', help='directories to watch for new files, adding them to the mapping file of each directory and processing them as they arrive')
+    parser.add_argument('--input_dir', type=dir_path, help='stash export directory of stash scenes to generate a yaml mapping file from')
     parser.add_argument('--db_path', type=file_path, help="path to stash database")
     parser.add_argument('--api_key', type=str, help="stash api key")
     parser.add_argument('--server_url', type=str, help="stash server url")
     parser.add_argument('--performer_only', type=str, help='simplified mapping of performers names and urls only')
     parser.add_argument('--parse_filenames', action='store_true', help='parse filename for metadata')
     parser.add_argument('--filename_pattern', type=str, help='regex pattern to use for filename parsing')
+    parser.add_argument('--workers', type=int, help='number of workers used to read stash exports, scan directories and parse filenames (default: number of cpus)')
+    parser.add_argument('--recursive', action='store_true', help='include files in subdirectories when generating a mapping from a directory')
+    parser.add_argument('--include_exts', type=str, help='comma separated file extensions to include when generating a mapping from a directory, i.e. .mp4,.mkv')
+    parser.add_argument('--exclude_exts', type=str, default=','.join(DEFAULT_EXCLUDE_EXTS), help='comma separated file extensions to skip when generating a mapping from a directory')
+    parser.add_argument('--full_scan', action='store_true', help="list every directory again instead of only directories changed since the last scan")
+    parser.add_argument('--poll_interval', type=float, default=DEFAULT_POLL_INTERVAL, help="seconds between checks of watched directories for new files")
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE, help="seconds a new file in a watched directory has to stay unchanged before it is added")
     parser.add_argument('--url_from_name', action='store_true', help='look up performer url from name')
+    parser.add_argument('--name_match_threshold', type=float, default=DEFAULT_NAME_MATCH_THRESHOLD, help="minimum similarity from 0 to 1 of an approximate performer name match with --url_from_name, 0 (the default) for exact names only")
     parser.add_argument('--create_performers', action='store_true', help='create missing performers')
     parser.add_argument('--update_stash', action='store_true', help='update stash scenes according to mapping')
     parser.add_argument('--no_update_mapfile', action='store_true', help="don't write changes to mapping file")
+    parser.add_argument('--plan', type=str, nargs='?', const='-', help="show the changes processing would make to stash without making them, saved as json to the given file or logged without one")
+    parser.add_argument('--backend', type=str, choices=['sqlite', 'api'], default='sqlite', help="update stash by writing to its database file (sqlite) or through the stash server's graphql api (api)")
+    parser.add_argument('--api_workers', type=int, default=DEFAULT_API_WORKERS, help="number of concurrent requests to stash with the api backend")
+    parser.add_argument('--path_rewrite', type=path_rewrite, action='append', help="OLD=NEW path prefix to replace in mapping paths that aren't in stash, i.e. D:\\Videos=/data/videos, can be given several times")
+    parser.add_argument('--match_files', action='store_true', help="match mapping paths that aren't in stash to stash scenes by oshash or phash fingerprint, or by file name and size")
+    parser.add_argument('--shared_db', action='store_true', help="use the stash database alongside a running stash server: switch it to WAL, read from a read-only snapshot and write in short transactions that wait for stash's locks")
+    parser.add_argument('--busy_timeout', type=float, default=DEFAULT_BUSY_TIMEOUT, help="seconds to wait for stash's database locks with --shared_db before retrying with backoff")
+    parser.add_argument('--transaction_time', type=float, default=DEFAULT_TRANSACTION_TIME, help="seconds a write transaction stays open with --shared_db before it is committed so stash can write")
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help="number of mapping entries written to stash per database transaction")
+    parser.add_argument('--no_index', action='store_true', help="don't preload scene paths, performers, tags and studios into memory (faster for very small mappings)")
+    parser.add_argument('--scrape_workers', type=int, default=DEFAULT_SCRAPE_WORKERS, help="number of performer urls scraped concurrently")
+    parser.add_argument('--scrape_rate', type=float, default=DEFAULT_SCRAPE_RATE, help="maximum scrape requests per second to each site, 0 for no limit")
+    parser.add_argument('--no_scrape_cache', action='store_true', help="don't read or write the scrape cache")
+    parser.add_argument('--purge_scrape_cache', action='store_true', help="delete all cached performer scrapes")
+    parser.add_argument('--scrape_cache_ttl', type=float, default=DEFAULT_CACHE_TTL_DAYS, help="days before a cached performer scrape expires, 0 to never expire")
+    parser.add_argument('--incremental', action='store_true', help="skip mapping entries that haven't changed since they were last processed")
+    parser.add_argument('--resume', action='store_true', help="continue the last process run of the mapping file if it was interrupted")
+    parser.add_argument('--no_journal', action='store_true', help="don't record processed mapping entries in a journal file")
+    parser.add_argument('--profile', type=str, help="write phase timings, counters and latencies of the run to a file, json if the file ends with .json, otherwise text")
+    parser.add_argument('--cprofile', type=str, help="write cProfile stats of the run to a file")
     parser.add_argument('--log_level', type=int, default=3, choices=range(1, 6), help="log levels: 1=trace, 2=debug, 3=info, 4=warn, 5=error")
     args = parser.parse_args()
 
     log.plugin = False
     log.log_level = LogLevel(args.log_level)
 
+    if args.cprofile:
+        prof.start_cprofile()
+
+    if args.purge_scrape_cache:
+        scrape_cache = ScrapeCache()
+        scrape_cache.purge()
+        scrape_cache.close()
+
+    if args.convert:
+        if not args.output:
+            parser.error("--convert needs an --output file")
+        count = convert_mapping(args.convert, args.output)
+        log.LogInfo(f"converted {count} mapping entries from {args.convert} to {args.output}")
+
     if args.directory:
         mapfile = args.output
         if not mapfile:
             mapfile = os.path.join(args.directory, 'mapping.yaml')
-        generate_mapping_from_directory(args.directory, mapfile, args.performer_only, args.parse_filenames, args.filename_pattern)
+        generate_mapping_from_directory(args.directory, mapfile, args.performer_only, args.parse_filenames, args.filename_pattern, recursive=args.recursive, include_exts=args.include_exts, exclude_exts=args.exclude_exts, workers=args.workers, use_scan_index=not args.full_scan)
 
     if args.input_zip:
         mapfile = args.output
         if not mapfile:
             mapfile = os.path.join(os.path.dirname(args.input_zip), 'mapping.yaml')
-        generate_mapping_from_export_zip(args.input_zip, mapfile, args.performer_only, args.parse_filenames, args.filename_pattern)
+        generate_mapping_from_export_zip(args.input_zip, mapfile, args.performer_only, args.parse_filenames, args.filename_pattern, workers=args.workers)
 
     if args.input_dir:
         mapfile = args.output
         if not mapfile:
             mapfile = os.path.join(os.path.dirname(args.input_dir), 'mapping.yaml')
-        generate_mapping_from_export_dir(args.input_dir, mapfile, args.performer_only, args.parse_filenames, args.filename_pattern)
+        generate_mapping_from_export_dir(args.input_dir, mapfile, args.performer_only, args.parse_filenames, args.filename_pattern, workers=args.workers)
 
-    if args.process:
+    if args.watch and args.output and len(args.watch) > 1:
+        parser.error("--output can only be used when watching one directory")
+    if args.batch:
+        for path in args.batch:
+            if not os.path.exists(path):
+                parser.error(f"{path} is not a valid path")
+        if args.plan and args.plan != '-':
+            parser.error("--plan with --batch logs the changes of each mapping file and can't save them to a file")
+    # watching only needs stash to process the new entries
+    use_stash = args.process or args.batch or (args.watch and (args.update_stash or args.create_performers or args.url_from_name))
+
+    if use_stash:
         db_path = args.db_path or config.db_path
         api_key = args.api_key or config.api_key
         server_url = args.server_url or config.server_url
 
-        if not db_path:
+        if not db_path and args.backend == 'sqlite':
             log.LogError("missing stash database path")
             sys.exit(1)
         if not server_url:
@@ -74,14 +149,45 @@ if __name__ == '__main__':
 
         client = StashInterface(None, api_key=api_key, server_url=server_url)
 
-        try:
-            db = StashDatabase(db_path)
-        except Exception as e:
-            log.LogError(str(e))
-            sys.exit(0)
+        db = None
+        if args.backend == 'sqlite':
+            try:
+                if args.shared_db:
+                    db = SharedStashDatabase(db_path, args.busy_timeout, args.transaction_time)
+                else:
+                    db = StashDatabase(db_path, None, None)
+            except Exception as e:
+                log.LogError(str(e))
+                sys.exit(0)
 
+        scrape_cache = None if args.no_scrape_cache else ScrapeCache(ttl_days=args.scrape_cache_ttl)
+    else:
+        client = None
+        db = None
+        scrape_cache = None
+
+    if args.process:
         outfile = args.output or args.process
         update_mapfile = not args.no_update_mapfile
-        process_mapping(client, db, args.process, outfile, url_from_name=args.url_from_name, create_performers=args.create_performers, update_mapfile=update_mapfile, update_stash=args.update_stash)
+        journal_path = None if args.no_journal else args.process + '.journal'
+        process_mapping(client, db, args.process, outfile, url_from_name=args.url_from_name, create_performers=args.create_performers, update_mapfile=update_mapfile, update_stash=args.update_stash, batch_size=args.batch_size, preload_index=not args.no_index, scrape_workers=args.scrape_workers, scrape_rate=args.scrape_rate, scrape_cache=scrape_cache, journal_path=journal_path, incremental=args.incremental, resume=args.resume, plan_path=args.plan, api_workers=args.api_workers, name_match_threshold=args.name_match_threshold, path_rewrites=args.path_rewrite, match_files=args.match_files)
+
+    if args.batch:
+        process_mappings(client, db, args.batch, url_from_name=args.url_from_name, create_performers=args.create_performers, update_mapfile=not args.no_update_mapfile, update_stash=args.update_stash, batch_size=args.batch_size, preload_index=not args.no_index,
+            scrape_workers=args.scrape_workers, scrape_rate=args.scrape_rate, scrape_cache=scrape_cache, journal=not args.no_journal, incremental=args.incremental, resume=args.resume, plan=bool(args.plan),
+            api_workers=args.api_workers, name_match_threshold=args.name_match_threshold, report_path=args.batch_report, path_rewrites=args.path_rewrite, match_files=args.match_files)
+
+    if args.watch:
+        watch_directories(client, db, args.watch, args.output, args.performer_only, args.parse_filenames, args.filename_pattern, recursive=args.recursive, include_exts=args.include_exts, exclude_exts=args.exclude_exts,
+            url_from_name=args.url_from_name, create_performers=args.create_performers, update_stash=args.update_stash, batch_size=args.batch_size, scrape_workers=args.scrape_workers, scrape_rate=args.scrape_rate, scrape_cache=scrape_cache,
+            api_workers=args.api_workers, name_match_threshold=args.name_match_threshold, poll_interval=args.poll_interval, debounce=args.debounce, path_rewrites=args.path_rewrite, match_files=args.match_files)
+
+    if scrape_cache:
+        scrape_cache.close()
+    if db:
+        db.close()
 
-        db.close()
\ No newline at end of file
+    if args.cprofile:
+        prof.write_cprofile(args.cprofile)
+    if args.profile:
+        prof.write_summary(args.profile)
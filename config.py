@@ -1,3 +1,5 @@
 db_path = r"K:\Stash\stash-go.sqlite"
 api_key = ""
-server_url = "http://localhost:9999/graphql"
\ No newline at end of file
+server_url = "http://localhost:9999/graphql"
+# write phase timings, counters and latencies of plugin runs to this file, json if it ends with .json
+profile_path = ""
@@ -0,0 +1,128 @@
+import json
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from stashlib.logger import logger as log
+from scene_resolver import fingerprint_key
+
+"""Streaming reads of scene file paths and file fingerprints from stash exports
+"""
+
+DEFAULT_CHUNK_SIZE = 500
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def scene_filepaths(data):
+    """All file paths of an exported scene, the primary file first
+    """
+    files = data.get('files') or []
+    return [file for file in files if isinstance(file, str)]
+
+def file_info(data):
+    """(path, {size, oshash, phash}) of an exported file, phash as the hex string the api shows
+    """
+    info = {}
+    if data.get('size'):
+        info['size'] = int(data['size'])
+    for fingerprint in data.get('fingerprints') or []:
+        key = fingerprint_key(fingerprint.get('type'), fingerprint.get('fingerprint'))
+        if key and key[0] == 'phash':
+            info['phash'] = f"{key[1]:016x}"
+        elif key and key[0] == 'oshash':
+            info['oshash'] = key[1]
+    return [(data['path'], info)] if data.get('path') else []
+
+def _read_zip_chunk(exportfile, names, read=scene_filepaths):
+    items = []
+    errors = []
+    with zipfile.ZipFile(exportfile, 'r') as archive:
+        for name in names:
+            try:
+                items += read(json.loads(archive.read(name)))
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+    return items, errors
+
+def _read_dir_chunk(jsonfiles, read=scene_filepaths):
+    items = []
+    errors = []
+    for jsonfile in jsonfiles:
+        try:
+            with open(jsonfile, encoding='utf-8') as f:
+                items += read(json.load(f))
+        except Exception as e:
+            errors.append(f"{jsonfile}: {e}")
+    return items, errors
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _iter_chunk_results(fn, args_chunks, workers):
+    """Runs fn over chunks on a process pool, yielding results in order.
+    At most two chunks per worker are in flight so memory stays bounded on very large exports.
+    """
+    if workers <= 1:
+        for args in args_chunks:
+            yield fn(*args)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for args in args_chunks:
+            futures.append(executor.submit(fn, *args))
+            if len(futures) >= workers * 2:
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+def _iter_items(results, kind='scene'):
+    for items, errors in results:
+        for error in errors:
+            log.LogWarning(f"error reading exported {kind} {error}")
+        yield from items
+
+def _zip_names(exportfile, folder):
+    with zipfile.ZipFile(exportfile, 'r') as archive:
+        return [name for name in archive.namelist() if name.startswith(folder + '/') and not name.endswith('/')]
+
+def _dir_files(exportdir, folder):
+    folderpath = os.path.join(exportdir, folder)
+    if not os.path.isdir(folderpath):
+        return
+    yield from (entry.path for entry in os.scandir(folderpath) if entry.is_file())
+
+def iter_export_zip_filepaths(exportfile, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the file paths of every scene in a stash export zip
+    """
+    workers = workers or default_workers()
+    names = _zip_names(exportfile, 'scenes')
+    log.LogInfo(f"reading {len(names)} exported scenes with {workers} workers")
+    yield from _iter_items(_iter_chunk_results(_read_zip_chunk, ((exportfile, chunk) for chunk in _chunks(names, chunk_size)), workers))
+
+def iter_export_dir_filepaths(exportdir, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the file paths of every scene in a stash export directory
+    """
+    workers = workers or default_workers()
+    scenejsonfiles = _dir_files(exportdir, 'scenes')
+    yield from _iter_items(_iter_chunk_results(_read_dir_chunk, ((chunk, ) for chunk in _chunks(scenejsonfiles, chunk_size)), workers))
+
+def iter_export_zip_files(exportfile, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (path, {size, oshash, phash}) of every file in a stash export zip, nothing for exports without files
+    """
+    workers = workers or default_workers()
+    names = _zip_names(exportfile, 'files')
+    yield from _iter_items(_iter_chunk_results(_read_zip_chunk, ((exportfile, chunk, file_info) for chunk in _chunks(names, chunk_size)), workers), 'file')
+
+def iter_export_dir_files(exportdir, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (path, {size, oshash, phash}) of every file in a stash export directory, nothing for exports without files
+    """
+    workers = workers or default_workers()
+    jsonfiles = _dir_files(exportdir, 'files')
+    yield from _iter_items(_iter_chunk_results(_read_dir_chunk, ((chunk, file_info) for chunk in _chunks(jsonfiles, chunk_size)), workers), 'file')
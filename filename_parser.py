@@ -0,0 +1,81 @@
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from stashlib.logger import logger as log
+from stashlib.scene_filename_parser import PATTERNS
+
+"""Batch filename parsing for generating mappings
+"""
+
+DEFAULT_CHUNK_SIZE = 2000
+
+@lru_cache(maxsize=None)
+def compile_patterns(pattern=None):
+    if pattern:
+        return [re.compile(pattern)]
+    return PATTERNS
+
+def parse_basename(filename, patterns):
+    """Same result as stashlib's parse_filename, using already compiled patterns
+    """
+    studio = None
+    performers = []
+    title = None
+    date = None
+    for pattern in patterns:
+        m = pattern.match(filename)
+        if m:
+            groups = m.groupdict()
+            if 'studio' in groups:
+                studio = groups['studio'].strip()
+            if 'performers' in groups:
+                performers = [x.strip() for x in groups['performers'].split(', ')]
+            if 'title' in groups:
+                title = groups['title'].strip()
+            if 'date' in groups:
+                date = groups['date'].replace('.', '-')
+            return True, studio, performers, title, date
+    return False, studio, performers, title, date
+
+def _parse_chunk(filenames, pattern):
+    patterns = compile_patterns(pattern)
+    return [parse_basename(filename, patterns) for filename in filenames]
+
+class FilenameParser:
+    """Parses filenames for metadata with the --filename_pattern compiled once.
+    Large batches are parsed in chunks on a process pool and results are memoized by filename,
+    since the same release names repeat across directories.
+    """
+
+    def __init__(self, pattern=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.pattern = pattern
+        self.patterns = compile_patterns(pattern)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self._results = {}
+
+    def parse(self, filename):
+        if filename not in self._results:
+            self._results[filename] = parse_basename(filename, self.patterns)
+        return self._results[filename]
+
+    def parse_all(self, filepaths):
+        """Parse the filenames of filepaths, returns a dict of filepath to parse result
+        """
+        start = time.perf_counter()
+        names = {filepath: os.path.splitext(os.path.basename(filepath))[0] for filepath in filepaths}
+        unparsed = list(dict.fromkeys(name for name in names.values() if name not in self._results))
+        if len(unparsed) > self.chunk_size and self.workers > 1:
+            chunks = [unparsed[i:i + self.chunk_size] for i in range(0, len(unparsed), self.chunk_size)]
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for chunk, results in zip(chunks, executor.map(_parse_chunk, chunks, [self.pattern] * len(chunks))):
+                    self._results.update(zip(chunk, results))
+        else:
+            for name in unparsed:
+                self.parse(name)
+        elapsed = time.perf_counter() - start
+        if names:
+            log.LogInfo(f"parsed {len(names)} filenames ({len(unparsed)} distinct) in {elapsed:.2f}s, {len(names) / max(elapsed, 1e-6):.0f} files/s")
+        return {filepath: self._results[name] for filepath, name in names.items()}
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import time
+from stashlib.logger import logger as log
+from mapping_io import json_default
+
+"""Checkpoint journal of processed mapping entries
+"""
+
+STATUS_DONE = 'done'
+STATUS_INCOMPLETE = 'incomplete'
+STATUS_FAILED = 'failed'
+
+def entry_hash(mapdata, options):
+    data = json.dumps([options, mapdata], sort_keys=True, default=json_default)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+class Journal:
+    """Append-only log of processed mapping entries, stored as json lines next to the mapping file.
+    Each entry record has the content hash of the entry before and after processing, its outcome
+    and, when processing changed the entry, the updated mapping data.
+    Records are appended once the entry's stash updates are committed, so a run that is killed
+    can be resumed and entries that haven't changed since they were applied can be skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.last_run = None
+        self.last_run_finished = True
+        self.run = None
+        self._file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partial line from a run that was killed mid-write
+                    continue
+                if 'event' in record:
+                    if record['event'] == 'start':
+                        self.last_run = record['run']
+                        self.last_run_finished = False
+                    elif record['event'] == 'end' and record['run'] == self.last_run:
+                        self.last_run_finished = True
+                else:
+                    self.records[record['key']] = record
+        log.LogDebug(f"loaded {len(self.records)} journal records from {self.path}")
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, default=json_default) + '\n')
+
+    def start_run(self, options):
+        """Rewrites the journal with the latest record of each entry and starts a new run
+        """
+        tmppath = self.path + '.tmp'
+        self._file = open(tmppath, 'w', encoding='utf-8')
+        if self.last_run is not None:
+            self._write({'event': 'start', 'run': self.last_run})
+        for record in self.records.values():
+            self._write(record)
+        if self.last_run is not None and self.last_run_finished:
+            self._write({'event': 'end', 'run': self.last_run})
+        self._file.close()
+        os.replace(tmppath, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self.run = f"{time.time():.6f}"
+        self._write({'event': 'start', 'run': self.run, 'options': options})
+        self._file.flush()
+
+    def completed(self, key, hash, incremental=False, resume=False):
+        """Returns the journal record if the entry was already applied and can be skipped
+        """
+        record = self.records.get(key)
+        if not record or record['status'] != STATUS_DONE or hash not in (record['hash'], record['output_hash']):
+            return None
+        if incremental:
+            return record
+        if resume and not self.last_run_finished and record['run'] == self.last_run:
+            return record
+        return None
+
+    def carry_over(self, record):
+        """Records a skipped entry as part of the current run so the run can also be resumed
+        """
+        record = dict(record, run=self.run)
+        self.records[record['key']] = record
+        self._write(record)
+
+    def record(self, key, hash, output_hash, status, data=None):
+        record = {
+            'key': key,
+            'run': self.run,
+            'hash': hash,
+            'output_hash': output_hash,
+            'status': status,
+        }
+        if data is not None:
+            record['data'] = data
+        self.records[key] = record
+        self._write(record)
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def finish_run(self):
+        if not self._file:
+            return
+        self._write({'event': 'end', 'run': self.run})
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
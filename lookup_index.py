@@ -0,0 +1,221 @@
+import math
+import re
+import unicodedata
+from stashlib.common import get_timestamp
+from stashlib.logger import logger as log
+from stashlib.stash_database import StashDatabase
+from stashlib.stash_models import PerformersRow, StudiosRow, TagsRow
+from profiler import profiler as prof
+from shared_database import SharedStashDatabase
+
+"""In-memory lookups of performers, tags and studios for processing mappings
+"""
+
+# minimum trigram similarity of an approximate performer name match, 0 to only match exact names.
+# Off by default, similar names are often different performers
+DEFAULT_NAME_MATCH_THRESHOLD = 0
+
+def normalize_url(url):
+    """url without the http(s) scheme, www. and trailing / and with a lowercase host.
+    The path and query are kept as they are, ids and usernames in them can be case sensitive.
+    """
+    url = url.strip()
+    for prefix in ('https://', 'http://'):
+        if url[:len(prefix)].lower() == prefix:
+            url = url[len(prefix):]
+            break
+    host, rest = re.match(r'([^/?#]*)(.*)', url, re.S).groups()
+    host = host.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return (host + rest).rstrip('/')
+
+def normalize_name(name):
+    """Lowercase name without accents or punctuation and with single spaces, so Jane  Doe, jane doe and Jàne Doe match
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.sub(r"[^\w]+", ' ', name.lower()).split())
+
+def token_key(key):
+    """Words of a normalized name in sorted order, so Doe Jane matches Jane Doe
+    """
+    return ' '.join(sorted(key.split()))
+
+def name_trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class LookupIndex:
+    """Resolves performers, tags and studios for mapping entries.
+    With preload enabled, every performer, tag and studio is read once and later lookups are dictionary hits.
+    Otherwise each lookup is a database query, which is cheaper for very small mappings.
+    Performers and tags created during a run are added so the index stays current.
+    Performer names and aliases are matched after normalizing, then by their words in any order,
+    then, if name_match_threshold isn't 0, by trigram similarity of at least name_match_threshold among the names sharing a word with the name,
+    or the names sharing its rarest trigrams when none do. Name lookups are memoized.
+    """
+
+    def __init__(self, db: StashDatabase, preload=True, name_match_threshold=DEFAULT_NAME_MATCH_THRESHOLD):
+        self.db = db
+        self.preload = preload
+        self.name_match_threshold = name_match_threshold
+        self._performers_by_id = {}
+        self._performers_by_url = {}
+        self._performers_by_name = {}
+        self._performers_by_tokens = {}
+        self._name_trigrams = {}
+        self._names_by_token = {}
+        self._names_by_trigram = {}
+        self._name_matches = {}
+        self._tags_by_name = {}
+        self._studios_by_name = {}
+        if preload:
+            self.load()
+
+    def load(self):
+        for row in self.db.fetchall("""SELECT id, name, disambiguation, url FROM performers"""):
+            self.add_performer(PerformersRow().from_sqliterow(row))
+        # aliases after every name so a performer's name takes precedence over another performer's alias
+        for row in self.db.fetchall("""SELECT performer_id, alias FROM performer_aliases"""):
+            self.add_alias(row[0], row[1])
+        for row in self.db.fetchall("""SELECT id, name FROM tags"""):
+            self.add_tag(TagsRow().from_sqliterow(row))
+        for row in self.db.fetchall("""SELECT id, name FROM studios"""):
+            studio = StudiosRow().from_sqliterow(row)
+            self._studios_by_name[studio.name] = studio
+        log.LogDebug(f"loaded {len(self._performers_by_id)} performers, {len(self._tags_by_name)} tags, {len(self._studios_by_name)} studios")
+
+    def add_performer(self, performer: PerformersRow):
+        if not self.preload:
+            return
+        self._performers_by_id[performer.id] = performer
+        if performer.url:
+            self._performers_by_url.setdefault(normalize_url(performer.url), performer)
+        if performer.name:
+            self._add_name(normalize_name(performer.name), performer)
+
+    def add_alias(self, performer_id, alias):
+        performer = self._performers_by_id.get(int(performer_id))
+        if performer and alias:
+            self._add_name(normalize_name(alias), performer)
+
+    def _add_name(self, key, performer):
+        if not key or key in self._performers_by_name:
+            return
+        self._performers_by_name[key] = performer
+        self._performers_by_tokens.setdefault(token_key(key), performer)
+        # the similarity indexes are only needed for approximate matching
+        if self.name_match_threshold:
+            for token in set(key.split()):
+                self._names_by_token.setdefault(token, []).append(key)
+            trigrams = name_trigrams(key)
+            self._name_trigrams[key] = trigrams
+            for trigram in trigrams:
+                self._names_by_trigram.setdefault(trigram, []).append(key)
+        # a new name can resolve names that didn't match before
+        self._name_matches.clear()
+
+    def add_tag(self, tag: TagsRow):
+        if not self.preload:
+            return
+        self._tags_by_name[tag.name] = tag
+
+    def performer_by_id(self, performer_id):
+        if not self.preload:
+            return self.db.performers.selectone_id(performer_id)
+        return self._performers_by_id.get(int(performer_id))
+
+    def performer_by_url(self, url):
+        if not self.preload:
+            return self.db.performers.selectone_url(url)
+        return self._performers_by_url.get(normalize_url(url))
+
+    def performer_by_name(self, name):
+        if not self.preload:
+            performers = self.db.query_performer_name(name)
+            return performers[0] if performers else None
+        key = normalize_name(name)
+        if key not in self._name_matches:
+            performer = self._performers_by_name.get(key) or self._performers_by_tokens.get(token_key(key)) or self._similar_name(key)
+            self._name_matches[key] = performer
+        return self._name_matches[key]
+
+    def _similar_name(self, key):
+        """Performer whose name or alias has the most trigrams in common with key, if similar enough and unambiguous
+        """
+        threshold = self.name_match_threshold
+        if not threshold or not key:
+            return None
+        trigrams = name_trigrams(key)
+        candidates = set()
+        for token in key.split():
+            candidates.update(self._names_by_token.get(token, ()))
+        if not candidates:
+            # a similar name shares at least min_shared trigrams, so it has one of the rarest len - min_shared + 1
+            min_shared = max(1, math.ceil(threshold * len(trigrams) / (2 - threshold)))
+            rarest = sorted(trigrams, key=lambda trigram: len(self._names_by_trigram.get(trigram, ())))
+            for trigram in rarest[:len(trigrams) - min_shared + 1]:
+                candidates.update(self._names_by_trigram.get(trigram, ()))
+        # names too much shorter or longer can't reach the threshold
+        min_len = threshold * len(trigrams) / (2 - threshold)
+        max_len = len(trigrams) * (2 - threshold) / threshold
+        best = None
+        best_score = 0
+        ambiguous = False
+        for candidate in candidates:
+            other = self._name_trigrams[candidate]
+            if not min_len <= len(other) <= max_len:
+                continue
+            score = 2 * len(trigrams & other) / (len(trigrams) + len(other))
+            if score > best_score:
+                best, best_score, ambiguous = candidate, score, False
+            elif score == best_score and self._performers_by_name[candidate] is not self._performers_by_name[best]:
+                ambiguous = True
+        if not best or best_score < threshold or ambiguous:
+            prof.count('performer_names_unmatched')
+            return None
+        prof.count('performer_names_similar')
+        performer = self._performers_by_name[best]
+        # the url of the match is written to the mapping, so every approximate match is shown for review
+        log.LogInfo(f"approximately matched performer name {key} to {performer.name} with similarity {best_score:.2f}")
+        return performer
+
+    def tag_by_name(self, name):
+        if not self.preload:
+            return self.db.tags.selectone_name(name)
+        return self._tags_by_name.get(name)
+
+    def studio_by_name(self, name):
+        if not self.preload:
+            return self.db.studios.selectone_name(name)
+        return self._studios_by_name.get(name)
+
+    def get_or_create_tag(self, name):
+        tag = self.tag_by_name(name)
+        if tag:
+            return tag
+        values = {
+            'name': name,
+            'created_at': get_timestamp(),
+            'updated_at': get_timestamp(),
+        }
+        if isinstance(self.db, SharedStashDatabase):
+            # the stash server may hold the write lock, take it like the batch writes do
+            c = self.db.write(lambda: self.db.tags.row_insert(values, commit=False))
+        else:
+            c = self.db.tags.row_insert(values)
+        tag = TagsRow().from_dict({'id': c.lastrowid, 'name': name})
+        log.LogInfo(f"created tag {name}")
+        self.add_tag(tag)
+        return tag
+
+    def created_performer(self, performer_id, performer_data):
+        performer = PerformersRow().from_dict({
+            'id': int(performer_id),
+            'name': performer_data.get('name'),
+            'disambiguation': performer_data.get('disambiguation'),
+            'url': performer_data.get('url'),
+        })
+        self.add_performer(performer)
+        return performer
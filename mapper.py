@@ -1,42 +1,55 @@
 import json
 import os
 import re
+import time
 import zipfile
-from stashlib.common import load_yaml, save_yaml, get_timestamp
 from stashlib.logger import logger as log
 from stashlib.stash_database import StashDatabase
-from stashlib.scene_filename_parser import parse_filename
 from stashlib.stash_interface import StashInterface
+from api_backend import DEFAULT_API_WORKERS
+from batch_writer import ChangePlan, DEFAULT_BATCH_SIZE
+from export_reader import iter_export_dir_filepaths, iter_export_dir_files, iter_export_zip_filepaths, iter_export_zip_files
+from filename_parser import FilenameParser
+from journal import Journal, entry_hash, STATUS_DONE, STATUS_FAILED, STATUS_INCOMPLETE
+from lookup_index import DEFAULT_NAME_MATCH_THRESHOLD
+from mapping_io import append_mapping, iter_mapping, load_mapping, save_mapping, MappingWriter, MAPPING_FORMATS
+from performer_lookup import find_performers, DEFAULT_LOOKUP_BATCH_SIZE, DEFAULT_LOOKUP_WORKERS
+from processing_context import ProcessingContext
+from profiler import profiler as prof
+from scanner import DirectoryScanner, DEFAULT_EXCLUDE_EXTS, parse_exts
+from scene_resolver import file_fields
+from scrape_cache import ScrapeCache
+from scraper import PerformerScraper, scrape_performer, SCRAPE_FAILED, DEFAULT_SCRAPE_WORKERS, DEFAULT_SCRAPE_RATE
+from watcher import DirectoryWatcher, DEFAULT_POLL_INTERVAL, DEFAULT_DEBOUNCE, PARTIAL_EXTS
 
 """Functions for creating mapping files, creating performers, and updating stash scenes
 """
 
-skip_exts = ['.jpg', '.txt', '.json', '.yml', '.yaml']
-
-performer_fields = ["name", "url", "gender", "birthdate", "ethnicity",
-            "country", "eye_color", "height", "measurements", "fake_tits",
-            "career_length", "tattoos", "piercings", "aliases", "twitter",
-            "instagram", "favorite", "tag_ids", "image", "stash_ids",
-            "rating", "details", "death_date", "hair_color", "weight"]
-
-def create_performer_from_url(client: StashInterface, url, name=None):
-    scraped_data = client.scrapePerformerURL(url)
-    log.LogDebug(f"scraped performer: {url} {name}")
+# seconds before a watch reloads the stash index, picking up performers and tags created outside the mapper
+DEFAULT_REFRESH_INTERVAL = 600
+# seconds a watch keeps checking for the stash scene of a new file
+DEFAULT_SCENE_WAIT = 3600
+SCENE_RETRY_INTERVAL = 30
+# names of the mapping files found in directories by process_mappings
+MAPPING_FILENAMES = ['mapping' + ext for ext in MAPPING_FORMATS]
+
+def create_performer_from_url(client: StashInterface, url, name=None, scraper: PerformerScraper=None):
+    if scraper:
+        scraped_data = scraper.scrape(url)
+    else:
+        try:
+            scraped_data = scrape_performer(client, url)
+        except Exception as e:
+            log.LogWarning(f"failed to scrape {url}: {e}")
+            scraped_data = SCRAPE_FAILED
+    # a name only performer would keep the url from being scraped again
+    if scraped_data is SCRAPE_FAILED:
+        log.LogWarning(f"not creating performer {url} until it can be scraped")
+        return None, None
     if scraped_data:
-        if scraped_data["images"]:
-            scraped_data["image"] = scraped_data["images"][0]
-        for k in list(scraped_data.keys()):
-            if k not in performer_fields:
-                del scraped_data[k]
-        scraped_data["gender"] = scraped_data["gender"].upper()
+        scraped_data = dict(scraped_data)
         if name:
             scraped_data["name"] = name
-        if scraped_data['birthdate'] and not re.match(r'\d\d\d\d\-\d\d\-\d\d', scraped_data['birthdate']):
-            del scraped_data['birthdate']
-        if scraped_data['death_date'] and not re.match(r'\d\d\d\d\-\d\d\-\d\d', scraped_data['death_date']):
-            del scraped_data['death_date']
-        del scraped_data['aliases']
-        del scraped_data['height']
     elif name:
         scraped_data = {
             "name": name,
@@ -46,47 +59,77 @@ def create_performer_from_url(client: StashInterface, url, name=None):
         log.LogError(f"no scrape data: {url} and no name")
         return None, None
     log.LogDebug(f"creating performer: {url} {name}")
-    performer_id = client.createPerformer(scraped_data)
+    with prof.phase('create_performers'):
+        performer_id = client.createPerformer(scraped_data)
+    if performer_id:
+        prof.count('performers_created')
     log.LogInfo(f"created performer id {performer_id}")
     return performer_id, scraped_data
 
-def generate_mapping_from_export_dir(exportdir, outfile, performer_only, parse_filenames, filename_pattern=None):
-    try:
-        filepaths = []
-        scenesdir = os.path.join(exportdir, 'scenes')
-        for file in os.listdir(scenesdir):
-            scenejsonfile = os.path.join(scenesdir, file)
-            mapping = json.load(open(scenejsonfile, encoding='utf-8'))
-            filepaths.append(mapping['files'][0])
-    except:
+def generate_mapping_from_export_dir(exportdir, outfile, performer_only, parse_filenames, filename_pattern=None, workers=None):
+    if not os.path.isdir(os.path.join(exportdir, 'scenes')):
         raise Exception(f"error processing {exportdir}")
-    generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern)
+    file_info = dict(prof.iter_phase('read_export', iter_export_dir_files(exportdir, workers)))
+    filepaths = prof.iter_phase('read_export', iter_export_dir_filepaths(exportdir, workers))
+    generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern, workers=workers, file_info=file_info)
 
-def generate_mapping_from_export_zip(exportfile, outfile, performer_only, parse_filenames, filename_pattern=None):
-    try:
-        filepaths = []
-        archive = zipfile.ZipFile(exportfile, 'r')
-        for name in archive.namelist():
-            if name.startswith('scenes/'):
-                mapping = json.loads(archive.read(name))
-                filepaths.append(mapping['files'][0])
-    except:
+def generate_mapping_from_export_zip(exportfile, outfile, performer_only, parse_filenames, filename_pattern=None, workers=None):
+    if not zipfile.is_zipfile(exportfile):
         raise Exception("error reading mapping.json from export file")
-    generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern)
-
-def generate_mapping_from_directory(dirpath, outfile, performer_only, parse_filenames, filename_pattern=None):
-    filepaths = [os.path.join(dirpath, file) for file in os.listdir(dirpath)]
-    generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern)
-
-def generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern=None):
-    mapping = load_yaml(outfile)
+    file_info = dict(prof.iter_phase('read_export', iter_export_zip_files(exportfile, workers)))
+    filepaths = prof.iter_phase('read_export', iter_export_zip_filepaths(exportfile, workers))
+    generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern, workers=workers, file_info=file_info)
+
+def generate_mapping_from_directory(dirpath, outfile, performer_only, parse_filenames, filename_pattern=None, recursive=False, include_exts=None, exclude_exts=DEFAULT_EXCLUDE_EXTS, workers=None, use_scan_index=True):
+    # without an existing mapping every file needs an entry, so the previous scan can't be used
+    index_path = outfile + '.scan' if use_scan_index else None
+    if index_path and not os.path.isfile(outfile) and os.path.isfile(index_path):
+        os.remove(index_path)
+    scanner = DirectoryScanner(recursive, include_exts, exclude_exts, workers, index_path)
+    # file_info is filled in as the scan is consumed, before the entries are created
+    generate_mapping(prof.iter_phase('scan_files', scanner.scan(dirpath)), outfile, performer_only, parse_filenames, filename_pattern, check_files=False, workers=workers,
+        file_info=scanner.file_info)
+    scanner.save_index()
+
+@prof.profiled('generate_mapping')
+def generate_mapping(filepaths, outfile, performer_only, parse_filenames, filename_pattern=None, check_files=True, workers=None, file_info=None):
+    """Add an entry for each file path that isn't already in the mapping file.
+    Existing entries are kept as they are so hand edits aren't lost.
+    file_info has the size and fingerprints of files from the directory scan or a stash export, see new_mapping_entries.
+    """
+    with prof.phase('load_mapping'):
+        mapping = load_mapping(outfile)
+    new_filepaths = []
     for filepath in filepaths:
-        if not os.path.isfile(filepath):
-            continue
-        filename, ext = os.path.splitext(os.path.basename(filepath))
-        if ext in skip_exts:
+        if filepath in mapping:
             continue
+        if check_files:
+            if not os.path.isfile(filepath):
+                continue
+            filename, ext = os.path.splitext(os.path.basename(filepath))
+            if ext.lower() in DEFAULT_EXCLUDE_EXTS:
+                continue
+        new_filepaths.append(filepath)
+
+    mapping.update(new_mapping_entries(new_filepaths, performer_only, parse_filenames, FilenameParser(filename_pattern, workers) if parse_filenames else None, file_info))
+    with prof.phase('save_mapping'):
+        save_mapping(outfile, dict(sorted(mapping.items())))
+    prof.progress(1)
+
+def new_mapping_entries(filepaths, performer_only, parse_filenames, parser: FilenameParser=None, file_info=None):
+    """Blank mapping entries for file paths, prefilled from their filenames with parse_filenames.
+    Scene entries record the size, oshash and phash of the file from file_info,
+    so --match_files still finds the scene after the file moves. Files aren't read or stat'ed for them.
+    """
+    mapping = {}
+    parse_results = {}
+    if parse_filenames:
+        with prof.phase('parse_filenames'):
+            parse_results = parser.parse_all(filepaths)
+
+    for i, filepath in enumerate(filepaths):
         log.LogInfo(filepath)
+        prof.progress(i / len(filepaths))
 
         if not performer_only:
             mapping[filepath] = {
@@ -98,7 +141,7 @@ def generate_mapping(filepaths, outfile, performer_only, parse_filenames, filena
 
         if parse_filenames:
 
-            parsed, studio, performers, title, date = parse_filename(os.path.splitext(os.path.basename(filepath))[0], filename_pattern)
+            parsed, studio, performers, title, date = parse_results[filepath]
             log.LogDebug(f"{parsed}, {studio}, {performers}, {title}, {date}")
 
             if parsed:
@@ -127,8 +170,10 @@ def generate_mapping(filepaths, outfile, performer_only, parse_filenames, filena
             mapping[filepath] = mapping_performers
         else:
             mapping[filepath]['performers'] = mapping_performers
+            mapping[filepath].update(file_fields((file_info or {}).get(filepath)))
     
-    save_yaml(outfile, mapping)
+    prof.count('entries_generated', len(filepaths))
+    return mapping
 
 def get_scene_from_filepath(client: StashInterface, filepath):
     scenes = client.findScenesByPathRegex(re.escape(filepath))
@@ -136,39 +181,124 @@ def get_scene_from_filepath(client: StashInterface, filepath):
         return scenes[0]
     return None
 
-def process_mapping(client: StashInterface, db: StashDatabase, mapfile, outfile, url_from_name=False, create_performers=True, update_mapfile=True, update_stash=False):
-    mapping = load_yaml(mapfile)
-
-    for filepath, mapdata in mapping.items():
-        performer_only = isinstance(mapdata, list)
+def get_mapping_performers(mapdata):
+    if isinstance(mapdata, list):
+        return mapdata
+    return mapdata['performers']
+
+@prof.profiled('process_mapping')
+def process_mapping(client: StashInterface, db: StashDatabase, mapfile, outfile, url_from_name=False, create_performers=True, update_mapfile=True, update_stash=False, batch_size=DEFAULT_BATCH_SIZE, preload_index=True, scrape_workers=DEFAULT_SCRAPE_WORKERS, scrape_rate=DEFAULT_SCRAPE_RATE, scrape_cache: ScrapeCache=None, journal_path=None, incremental=False, resume=False, plan_path=None, api_workers=DEFAULT_API_WORKERS, name_match_threshold=DEFAULT_NAME_MATCH_THRESHOLD, context: ProcessingContext=None, entries=None, prefetch=True, path_rewrites=None, match_files=False):
+    """Process a mapping file, with plan_path the changes to stash are saved to plan_path, or logged if it is -, instead of being made
+    Without a database, stash is read and updated through the api
+    With a context, its already loaded lookups and scraper are used instead of loading new ones
+    With entries, the given dict of mapping entries is processed in place of reading mapfile
+    Without prefetch, performer urls aren't scraped up front, for callers that already did
+    Entries whose path isn't in stash are looked up again with path_rewrites applied, and with match_files by fingerprint or file name and size
+    Returns the numbers of entries processed, skipped and failed, and of scene changes made and unchanged values skipped
+    """
+    options = {
+        'url_from_name': url_from_name,
+        'create_performers': create_performers,
+        'update_stash': update_stash,
+    }
+    plan = ChangePlan() if plan_path else None
+    if plan:
+        # a plan doesn't change anything, so there's nothing to journal or write back to the mapping
+        journal_path = None
+        update_mapfile = False
+    journal = Journal(journal_path) if journal_path else None
+    # entries waiting for their stash updates to be committed before they are journaled
+    unjournaled = {}
+
+    def journal_entries(keys, failed):
+        for key in keys:
+            hash, output_hash, complete, data = unjournaled.pop(key)
+            if key in failed:
+                status = STATUS_FAILED
+            elif complete:
+                status = STATUS_DONE
+            else:
+                status = STATUS_INCOMPLETE
+            journal.record(key, hash, output_hash, status, data)
+        journal.flush()
+
+    on_flush = journal_entries if journal else None
+    if not context:
+        context = ProcessingContext(client, db, preload_index, scrape_workers, scrape_rate, scrape_cache, api_workers, name_match_threshold, path_rewrites=path_rewrites, match_files=match_files)
+    index = context.index
+    resolver = context.resolver
+    scraper = context.scraper
+    writer = context.writer(batch_size, on_flush, plan)
+
+    def read_mapping(progress=None):
+        if entries is not None:
+            return iter(list(entries.items()))
+        return iter_mapping(mapfile, progress)
+
+    # scrape all missing performer urls of entries with stash scenes up front so performer creation doesn't wait on each scrape
+    if create_performers and prefetch and not plan:
+        with prof.phase('scrape_prefetch'):
+            scraper.prefetch(actor['url'] for filepath, mapdata in read_mapping() for actor in get_mapping_performers(mapdata)
+                if actor['url'] and not index.performer_by_url(actor['url']) and resolver.scene_ids(filepath, mapdata))
+
+    if journal:
+        journal.start_run(options)
+    processed = 0
+    skipped = 0
+
+    # entries are written to the output mapping as they are processed
+    out = MappingWriter(outfile) if update_mapfile else None
 
-        if performer_only:
-            performers = mapdata
-        else:
-            performers = mapdata['performers']
-
-        scenes = db.get_scenes_from_filepath(filepath)
-        for scene in scenes:
-            if not performer_only and update_stash:
-                if mapdata['title']:
-                    db.scenes.update_title_by_id(scene.id, mapdata['title'], False)
-                if mapdata['date']:
-                    db.scenes.update_date_by_id(scene.id, mapdata['date'], False)
-                if 'details' in mapdata and mapdata['details']:
-                    db.scenes.update_details_by_id(scene.id, mapdata['details'], False)
-                if 'studio' in mapdata and mapdata['studio']:
-                    studio = db.studios.selectone_name(mapdata['studio'])
-                    if studio:
-                        db.scenes.update_studio_id_by_id(scene.id, studio.id, False)
-                db.commit()
-                if 'tags' in mapdata and mapdata['tags']:
-                    for tag_name in mapdata['tags']:
-                        tag = db.tags.selectone_name(tag_name)
-                        if not tag:
-                            db.tags.insert(tag_name, get_timestamp(), get_timestamp(), commit=True)
-                            tag = db.tags.selectone_name(tag_name)
-                        if tag:
-                            db.add_tag_to_scene(scene, tag, commit=True)
+    try:
+        for filepath, mapdata in prof.iter_phase('read_mapping', read_mapping(prof.progress)):
+            prof.count('entries_processed')
+            processed += 1
+            if journal:
+                hash = entry_hash(mapdata, options)
+                record = journal.completed(filepath, hash, incremental, resume)
+                if record:
+                    journal.carry_over(record)
+                    skipped += 1
+                    prof.count('entries_skipped')
+                    if out:
+                        out.write(filepath, record.get('data', mapdata))
+                    continue
+
+            performer_only = isinstance(mapdata, list)
+            performers = get_mapping_performers(mapdata)
+            complete = True
+
+            with prof.phase('resolve_scenes'):
+                scene_ids = resolver.scene_ids(filepath, mapdata)
+            if not scene_ids:
+                # performers are only looked up and created for files that are stash scenes,
+                # so the entry is processed again once its scene is in stash
+                if update_stash or performers:
+                    complete = False
+                performers = []
+            writer.begin_entry(filepath)
+            for scene_id in scene_ids:
+                if not performer_only and update_stash:
+                    if mapdata['title']:
+                        writer.update_scene(scene_id, 'title', mapdata['title'])
+                    if mapdata['date']:
+                        writer.update_scene(scene_id, 'date', mapdata['date'])
+                    if 'details' in mapdata and mapdata['details']:
+                        writer.update_scene(scene_id, 'details', mapdata['details'])
+                    if 'studio' in mapdata and mapdata['studio']:
+                        studio = index.studio_by_name(mapdata['studio'])
+                        if studio:
+                            writer.update_scene(scene_id, 'studio_id', studio.id)
+                    if 'tags' in mapdata and mapdata['tags']:
+                        for tag_name in mapdata['tags']:
+                            if plan:
+                                tag = index.tag_by_name(tag_name)
+                                if not tag:
+                                    plan.create_tag(filepath, tag_name)
+                                    continue
+                            else:
+                                tag = index.get_or_create_tag(tag_name)
+                            writer.add_tag(scene_id, tag.id)
 
             for actor in performers:
                 name = actor['name']
@@ -179,19 +309,24 @@ def process_mapping(client: StashInterface, db: StashDatabase, mapfile, outfile,
                 # if only name and no url, try to find url from name
                 if name and not url:
                     if url_from_name:
-                        performer = db.query_performer_name(name)
+                        performer = index.performer_by_name(name)
                         if performer:
                             actor['url'] = performer.url
                 # if only url and no name, try to find name from url
                 elif url:
-                    performer = db.performers.selectone_url(url)
+                    performer = index.performer_by_url(url)
                     # try to create performer if url not found
                     if not performer:
-                        if create_performers:
+                        complete = False
+                        if create_performers and plan:
+                            plan.create_performer(filepath, url)
+                        elif create_performers:
                             log.LogDebug(f'creating missing performer {url}')
-                            performer_id, scraped_data = create_performer_from_url(client, url, name)
+                            performer_id, scraped_data = create_performer_from_url(client, url, name, scraper)
                             # get name from performer if create successful
                             if performer_id:
+                                complete = True
+                                index.created_performer(performer_id, scraped_data)
                                 actor['name'] = scraped_data["name"]
                                 log.LogInfo(f"created performer {actor['name']}")
                             else:
@@ -200,17 +335,117 @@ def process_mapping(client: StashInterface, db: StashDatabase, mapfile, outfile,
                         performer_id = performer.id
                         actor['name'] = performer.name
 
-                if scene and performer_id and update_stash:
-                    performer = db.performers.selectone_id(performer_id)
-                    if performer:
-                        db.add_performers_to_scene(scene, [performer])
+                if performer_id and update_stash:
+                    for scene_id in scene_ids:
+                        writer.add_performer(scene_id, performer_id)
 
                 log.LogDebug(f'\t{name} {url}')
-
-    if update_mapfile:
-        save_yaml(outfile, mapping)
-
-def map_directory_scene_files(client: StashInterface, dirpath, performer_only=True, parse_filenames=False, filename_pattern=None, url_from_name=False, create_performers=True, update_mapfile=True, update_stash=False):
+            if journal:
+                output_hash = entry_hash(mapdata, options)
+                unjournaled[filepath] = (hash, output_hash, complete, mapdata if output_hash != hash else None)
+            writer.end_entry()
+            if out:
+                with prof.phase('write_mapping'):
+                    out.write(filepath, mapdata)
+    except Exception:
+        # keep the stash updates of entries that finished before the error
+        writer.close()
+        if out:
+            out.abort()
+        if journal:
+            journal.close()
+        raise
+
+    writer.close()
+    if writer.entries_failed:
+        log.LogWarning(f"{writer.entries_failed} mapping entries failed to update")
+    if update_stash:
+        log.LogInfo(f"{writer.changes} scene changes, {writer.unchanged} unchanged values and links skipped")
+    if writer.lock_wait:
+        log.LogInfo(f"waited {writer.lock_wait:.2f}s for stash database locks")
+    if plan:
+        plan.write(plan_path)
+    if journal:
+        journal.finish_run()
+        log.LogInfo(f"skipped {skipped} unchanged mapping entries")
+
+    if out:
+        out.close()
+    prof.progress(1)
+    return {
+        'entries': processed,
+        'skipped': skipped,
+        'failed': writer.entries_failed,
+        'changes': writer.changes,
+        'unchanged': writer.unchanged,
+        'lock_wait': round(writer.lock_wait, 3),
+    }
+
+def find_mapping_files(paths):
+    """Mapping files among paths, with directories searched recursively for mapping.yaml, mapping.jsonl, ... files
+    """
+    mapfiles = []
+    for path in paths:
+        if not os.path.isdir(path):
+            mapfiles.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            mapfiles += [os.path.join(dirpath, filename) for filename in sorted(filenames)
+                if filename.lower() in MAPPING_FILENAMES]
+    return list(dict.fromkeys(mapfiles))
+
+@prof.profiled('process_mappings')
+def process_mappings(client: StashInterface, db: StashDatabase, paths, url_from_name=False, create_performers=True, update_mapfile=True, update_stash=False, batch_size=DEFAULT_BATCH_SIZE, preload_index=True, scrape_workers=DEFAULT_SCRAPE_WORKERS, scrape_rate=DEFAULT_SCRAPE_RATE, scrape_cache: ScrapeCache=None, journal=True, incremental=False, resume=False, plan=False, api_workers=DEFAULT_API_WORKERS, name_match_threshold=DEFAULT_NAME_MATCH_THRESHOLD, report_path=None, path_rewrites=None, match_files=False):
+    """Process many mapping files in one run, given as mapping files or directories to search for them.
+    The stash lookups and scrape results are loaded once and shared by every file, and performer urls of all files are scraped up front.
+    A file that fails is reported and the rest are still processed. With plan, the changes of each file are logged instead of made.
+    Returns the results of each file, also saved as json to report_path.
+    """
+    mapfiles = find_mapping_files(paths)
+    log.LogInfo(f"processing {len(mapfiles)} mapping files")
+    context = ProcessingContext(client, db, preload_index, scrape_workers, scrape_rate, scrape_cache, api_workers, name_match_threshold, path_rewrites=path_rewrites, match_files=match_files)
+
+    if create_performers and not plan:
+        with prof.phase('scrape_prefetch'):
+            urls = []
+            for mapfile in mapfiles:
+                try:
+                    urls += [actor['url'] for filepath, mapdata in iter_mapping(mapfile) for actor in get_mapping_performers(mapdata)
+                        if actor['url'] and not context.index.performer_by_url(actor['url']) and context.resolver.scene_ids(filepath, mapdata)]
+                except Exception as e:
+                    # reported when the file is processed
+                    log.LogDebug(f"can't read performer urls of {mapfile}: {e}")
+            context.scraper.prefetch(urls)
+
+    results = []
+    for i, mapfile in enumerate(mapfiles):
+        prof.progress(i / len(mapfiles))
+        start = time.perf_counter()
+        result = {'mapfile': mapfile}
+        try:
+            result.update(process_mapping(client, db, mapfile, mapfile, url_from_name=url_from_name, create_performers=create_performers, update_mapfile=update_mapfile, update_stash=update_stash, batch_size=batch_size,
+                journal_path=mapfile + '.journal' if journal else None, incremental=incremental, resume=resume, plan_path='-' if plan else None, context=context, prefetch=False))
+            log.LogInfo(f"{mapfile}: {result['entries']} entries, {result['skipped']} skipped, {result['changes']} scene changes, {result['failed']} failed")
+        except Exception as e:
+            result['error'] = str(e)
+            log.LogError(f"failed to process {mapfile}: {e}")
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        results.append(result)
+
+    errors = sum(1 for result in results if 'error' in result)
+    log.LogInfo(f"processed {len(results) - errors} mapping files with {sum(result.get('entries', 0) for result in results)} entries and {sum(result.get('changes', 0) for result in results)} scene changes, {errors} files failed")
+    lock_wait = sum(result.get('lock_wait', 0) for result in results)
+    if lock_wait:
+        log.LogInfo(f"waited {lock_wait:.2f}s for stash database locks")
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        log.LogInfo(f"results written to {report_path}")
+    prof.progress(1)
+    return results
+
+def map_directory_scene_files(client: StashInterface, db: StashDatabase, dirpath, performer_only=True, parse_filenames=False, filename_pattern=None, url_from_name=False, create_performers=True, update_mapfile=True, update_stash=False):
     """Generate a yaml file listing all scene files in a given directory
     Each scene file entry has pairs of performer names and urls
     The yaml file is processed and performers are created from urls and added to scenes.
@@ -222,16 +457,93 @@ def map_directory_scene_files(client: StashInterface, dirpath, performer_only=Tr
     if not os.path.isfile(mapfile):
         generate_mapping_from_directory(dirpath, mapfile, performer_only=performer_only, parse_filenames=parse_filenames, filename_pattern=filename_pattern)
     else:
-        process_mapping(client, mapfile, mapfile, url_from_name=url_from_name, create_performers=create_performers, update_mapfile=update_mapfile, update_stash=update_stash)
-
-def map_directory_performers(client: StashInterface, rootdir):
+        process_mapping(client, db, mapfile, mapfile, url_from_name=url_from_name, create_performers=create_performers, update_mapfile=update_mapfile, update_stash=update_stash)
+
+def watch_directories(client: StashInterface, db: StashDatabase, dirpaths, mapfile=None, performer_only=False, parse_filenames=False, filename_pattern=None, recursive=False, include_exts=None, exclude_exts=DEFAULT_EXCLUDE_EXTS,
+        url_from_name=False, create_performers=False, update_stash=False, batch_size=DEFAULT_BATCH_SIZE, scrape_workers=DEFAULT_SCRAPE_WORKERS, scrape_rate=DEFAULT_SCRAPE_RATE, scrape_cache: ScrapeCache=None,
+        api_workers=DEFAULT_API_WORKERS, name_match_threshold=DEFAULT_NAME_MATCH_THRESHOLD, poll_interval=DEFAULT_POLL_INTERVAL, debounce=DEFAULT_DEBOUNCE, refresh_interval=DEFAULT_REFRESH_INTERVAL, scene_wait=DEFAULT_SCENE_WAIT, path_rewrites=None, match_files=False):
+    """Watch directories for new files until interrupted.
+    Each new file gets an entry appended to the mapping.yaml of its directory, or mapfile, once it stops changing,
+    and the new entries are processed with stash lookups and scrape results kept loaded between files.
+    Entries of files stash hasn't added as scenes yet are processed again once it has, for up to scene_wait seconds.
+    """
+    mapfiles = {dirpath: mapfile or os.path.join(dirpath, 'mapping.yaml') for dirpath in dirpaths}
+    known = {}
+    scanners = {}
+    for dirpath, path in mapfiles.items():
+        with prof.phase('load_mapping'):
+            known[path] = {key for key, mapdata in iter_mapping(path)}
+        index_path = path + '.scan'
+        # without an existing mapping every file needs an entry, so the previous scan can't be used
+        if not known[path] and os.path.isfile(index_path):
+            os.remove(index_path)
+        scanners[dirpath] = DirectoryScanner(recursive, include_exts, list(parse_exts(exclude_exts)) + PARTIAL_EXTS, 1, index_path)
+
+    context = None
+    if update_stash or create_performers or url_from_name:
+        context = ProcessingContext(client, db, True, scrape_workers, scrape_rate, scrape_cache, api_workers, name_match_threshold, query_misses=True, refresh_interval=refresh_interval, path_rewrites=path_rewrites, match_files=match_files)
+    parser = FilenameParser(filename_pattern) if parse_filenames else None
+    # entries of files without a stash scene yet, with the time they were added
+    unresolved = {}
+    retried_at = time.monotonic()
+
+    def process(entries):
+        process_mapping(client, db, None, None, url_from_name=url_from_name, create_performers=create_performers, update_mapfile=False, update_stash=update_stash, batch_size=batch_size, context=context, entries=entries)
+
+    watcher = DirectoryWatcher(scanners, poll_interval, debounce)
+    log.LogInfo(f"watching {', '.join(dirpaths)}")
+    try:
+        while True:
+            for dirpath, filepaths in watcher.poll().items():
+                path = mapfiles[dirpath]
+                file_info = {filepath: watcher.file_info.pop(filepath, None) for filepath in filepaths}
+                filepaths = sorted(filepath for filepath in filepaths if filepath not in known[path])
+                if filepaths:
+                    entries = new_mapping_entries(filepaths, performer_only, parse_filenames, parser, file_info)
+                    if context:
+                        context.refresh()
+                        process(entries)
+                        now = time.monotonic()
+                        unresolved.update((key, (entries[key], now)) for key in entries if not context.resolver.scene_ids(key, entries[key]))
+                    with prof.phase('save_mapping'):
+                        append_mapping(path, entries)
+                    known[path].update(entries)
+                    log.LogInfo(f"added {len(entries)} new files to {path}")
+                # a saved index with unsettled files would hide them from the next run
+                if not watcher.pending(dirpath):
+                    scanners[dirpath].save_index()
+
+            if unresolved and time.monotonic() - retried_at >= SCENE_RETRY_INTERVAL:
+                retried_at = time.monotonic()
+                resolved = {key: mapdata for key, (mapdata, added_at) in unresolved.items() if context.resolver.scene_ids(key, mapdata)}
+                if resolved:
+                    process(resolved)
+                for key, (mapdata, added_at) in list(unresolved.items()):
+                    if key in resolved:
+                        del unresolved[key]
+                    elif retried_at - added_at >= scene_wait:
+                        log.LogWarning(f"no stash scene for {key} after {scene_wait:.0f}s, process the mapping after stash scans it")
+                        del unresolved[key]
+            watcher.wait()
+    except KeyboardInterrupt:
+        log.LogInfo("stopped watching")
+    finally:
+        watcher.close()
+
+@prof.profiled('map_directory_performers')
+def map_directory_performers(client: StashInterface, rootdir, scrape_workers=DEFAULT_SCRAPE_WORKERS, scrape_rate=DEFAULT_SCRAPE_RATE, scrape_cache: ScrapeCache=None, lookup_batch_size=DEFAULT_LOOKUP_BATCH_SIZE, lookup_workers=DEFAULT_LOOKUP_WORKERS):
     """Create and processing mapping file for performer root directory
     Creates performer if name and url is given and performer does not exist
     Checks if url exists and stash name does not match mapping name
+    Performers of all directories are looked up together in a few batched requests
     """
 
+    prof.instrument_client(client)
     mapfile = os.path.join(rootdir, 'mapping.yaml')
-    mapping = load_yaml(mapfile)
+    with prof.phase('load_mapping'):
+        mapping = load_mapping(mapfile)
+    missing = []
+    actors = []
 
     for dirname in os.listdir(rootdir):
         dirpath = os.path.join(rootdir, dirname)
@@ -247,32 +559,54 @@ def map_directory_performers(client: StashInterface, rootdir):
                 'url': ''
             }]
         else:
-            
-            for actor in mapping[dirpath]:
-                name = actor['name']
-                url = actor['url']
-                performer = None
-
-                # if only name and no url, try to find url from name
-                if name and not url:
-                    performer = client.findPerformerByName(name)
-                    if performer:
-                        actor['url'] = performer.get("url")
-                # if url and name, get performer if exists or create if not
-                elif name and url:
-                    performer = client.findPerformerByURL(url)
-                    # try to create performer if url not found
-                    if not performer:
-                        log.LogDebug(f'creating missing performer {url}')
-                        performer_id, scraped_data = create_performer_from_url(client, url, name)
-                        # get name from performer if create successful
-                        if performer_id:
-                            log.LogInfo(f"created performer {actor['name']}")
-                        else:
-                            log.LogWarning(f'failed to create performer {url}')
-                    elif performer.get("name") != actor['name']:
-                        log.LogWarning(f"existing performer name mismatch {actor['name']} {performer.get('name')}")
-
-                log.LogDebug(f'\t{name} {url}')
+            actors += mapping[dirpath]
+
+    with prof.phase('find_performers'):
+        by_url, by_name = find_performers(client,
+            urls=[actor['url'] for actor in actors if actor['name'] and actor['url']],
+            names=[(actor['name'], actor.get('disambiguation') or '') for actor in actors if actor['name'] and not actor['url']],
+            batch_size=lookup_batch_size, workers=lookup_workers)
+    prof.progress(0.5)
+
+    for actor in actors:
+        name = actor['name']
+        url = actor['url']
+        performer = None
+
+        # if only name and no url, try to find url from name
+        if name and not url:
+            performer = by_name[(name, actor.get('disambiguation') or '')]
+            if performer:
+                actor['url'] = performer.get("url")
+        # if url and name, get performer if exists or create if not
+        elif name and url:
+            performer = by_url[url]
+            # create performer after all missing urls are scraped
+            if not performer:
+                missing.append(actor)
+            elif performer.get("name") != actor['name']:
+                log.LogWarning(f"existing performer name mismatch {actor['name']} {performer.get('name')}")
+
+        log.LogDebug(f'\t{name} {url}')
+
+    scraper = PerformerScraper(client, scrape_workers, scrape_rate, scrape_cache)
+    with prof.phase('scrape_prefetch'):
+        scraper.prefetch(actor['url'] for actor in missing)
+    created = {}
+    for i, actor in enumerate(missing):
+        prof.progress(0.5 + i / len(missing) / 2)
+        url = actor['url']
+        if url in created:
+            continue
+        log.LogDebug(f'creating missing performer {url}')
+        performer_id, scraped_data = create_performer_from_url(client, url, actor['name'], scraper)
+        created[url] = performer_id
+        # get name from performer if create successful
+        if performer_id:
+            log.LogInfo(f"created performer {actor['name']}")
+        else:
+            log.LogWarning(f'failed to create performer {url}')
 
-    save_yaml(mapfile, mapping)
\ No newline at end of file
+    with prof.phase('save_mapping'):
+        save_mapping(mapfile, mapping)
+    prof.progress(1)
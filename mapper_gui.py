@@ -3,6 +3,7 @@ import PySimpleGUI as sg
 from stashlib.logger import logger as log
 from stashlib.stash_database import StashDatabase
 from stashlib.stash_interface import StashInterface
+from scrape_cache import ScrapeCache
 from mapper import generate_mapping_from_export_zip, generate_mapping_from_directory, generate_mapping_from_export_dir, process_mapping
 
 WINDOW_TITLE = 'Stash Metadata Mapper'
@@ -22,6 +23,7 @@ def generate_gui():
         [sg.Checkbox('Parse Filenames', key='parse_filenames')],
         [sg.Text('Filename Pattern', size=(12, 1)), sg.Input(key='filename_pattern')],
         [sg.Checkbox('Performer Only', key='performer_only', default=False)],
+        [sg.Checkbox('Include Subdirectories', key='recursive', default=False)],
     ]
     layout = [[sg.Text("Generate mapping")],
             [sg.Frame('Mapping Source', input_layout)],
@@ -45,6 +47,7 @@ def generate_gui():
         parse_filenames = values['parse_filenames']
         filename_pattern = values['filename_pattern'] or None
         performer_only = values['performer_only']
+        recursive = values['recursive']
         log.LogDebug(f"parse_filenames {parse_filenames} filename_pattern {filename_pattern} performer_only {performer_only}")
 
         if not dirpath and not exportfile:
@@ -61,7 +64,7 @@ def generate_gui():
             ## Create and process mapping of scenes in a site directory
             outfile = os.path.join(dirpath, outfilename)
             if dirpath:
-                generate_mapping_from_directory(dirpath, outfile, performer_only, parse_filenames, filename_pattern=filename_pattern)
+                generate_mapping_from_directory(dirpath, outfile, performer_only, parse_filenames, filename_pattern=filename_pattern, recursive=recursive)
             elif exportfile and exportfile.endswith(".zip"):
                 generate_mapping_from_export_zip(exportfile, outfile, performer_only, parse_filenames, filename_pattern=filename_pattern)
             elif exportfile and os.path.isdir(exportfile):
@@ -81,6 +84,7 @@ def process_gui(client: StashInterface, db: StashDatabase):
             [sg.Checkbox('Create Performers', key='create_performers', default=True)],
             [sg.Checkbox('Update Mapping File', key='update_mapfile', default=True)],
             [sg.Checkbox('Update Stash', key='update_stash')],
+            [sg.Checkbox('Skip Unchanged Entries', key='incremental')],
             [sg.Submit(button_text='Run', key='simple_map_directory_scene_files'), sg.Cancel()],
             ]
 
@@ -99,6 +103,7 @@ def process_gui(client: StashInterface, db: StashDatabase):
         create_performers = values['create_performers']
         update_mapfile = values['update_mapfile']
         update_stash = values['update_stash']
+        incremental = values['incremental']
         log.LogDebug(f"url_from_name {url_from_name} create_performers {create_performers} update_mapfile {update_mapfile} update_stash {update_stash}")
 
         if not mapfile:
@@ -116,7 +121,11 @@ def process_gui(client: StashInterface, db: StashDatabase):
 
         try:
             ## Create and process mapping of scenes in a site directory
-            process_mapping(client, db, mapfile, mapfile, url_from_name=url_from_name, create_performers=create_performers, update_mapfile=update_mapfile, update_stash=update_stash)
+            scrape_cache = ScrapeCache()
+            try:
+                process_mapping(client, db, mapfile, mapfile, url_from_name=url_from_name, create_performers=create_performers, update_mapfile=update_mapfile, update_stash=update_stash, scrape_cache=scrape_cache, journal_path=mapfile + '.journal', incremental=incremental)
+            finally:
+                scrape_cache.close()
             log.LogInfo(f"processed mapping {mapfile}")
             break
 
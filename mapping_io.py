@@ -0,0 +1,366 @@
+import json
+import os
+import yaml
+from yaml.events import AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent, SequenceEndEvent, SequenceStartEvent
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+
+"""Streaming reads and writes of mapping files in yaml, json lines or msgpack, chosen by file extension
+"""
+
+# use the libyaml C loader and dumper when pyyaml was built with them
+try:
+    from yaml import CFullLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import FullLoader as Loader, Dumper
+
+# msgpack mappings need the msgpack package
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAPPING_FORMATS = {
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.jsonl': 'jsonl',
+    '.msgpack': 'msgpack',
+}
+
+def mapping_format(filepath):
+    """Format of a mapping file from its extension, yaml for unknown extensions
+    """
+    return MAPPING_FORMATS.get(os.path.splitext(filepath)[1].lower(), 'yaml')
+
+def _require_msgpack():
+    if not msgpack:
+        raise Exception("msgpack mapping files need the msgpack package, run pip install msgpack")
+
+_unset = object()
+
+class Record:
+    """Mapping data with a fixed set of fields stored in __slots__, read and written like a dict.
+    A field that isn't set is missing like an absent dict key, keys that aren't fields are kept in extra.
+    """
+    __slots__ = ('extra', )
+    fields = frozenset()
+
+    def __init__(self, data=None):
+        for key, value in (data or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            if key in self.fields:
+                return getattr(self, key)
+            return self.extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+            return
+        try:
+            self.extra[key] = value
+        except AttributeError:
+            self.extra = {key: value}
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """The set fields and extra keys as a dict, without converting nested records
+        """
+        data = {}
+        for key in self.__slots__:
+            value = getattr(self, key, _unset)
+            if value is not _unset:
+                data[key] = value
+        data.update(getattr(self, 'extra', ()))
+        return data
+
+    def keys(self):
+        return list(self.to_dict())
+
+    def items(self):
+        return list(self.to_dict().items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return plain(self) == plain(other)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({plain(self)!r})"
+
+class MappingPerformer(Record):
+    __slots__ = ('name', 'disambiguation', 'url')
+    fields = frozenset(__slots__)
+
+class MappingEntry(Record):
+    # size and fingerprints are recorded for every generated entry, as slots they don't need an extra dict
+    __slots__ = ('url', 'date', 'title', 'details', 'studio', 'tags', 'performers', 'size', 'oshash', 'phash')
+    fields = frozenset(__slots__)
+
+def _performers(value):
+    if not isinstance(value, list):
+        return value
+    return [MappingPerformer(actor) if isinstance(actor, dict) else actor for actor in value]
+
+def entry_record(value):
+    """Mapping data as records, a performer only entry as a list of MappingPerformer
+    """
+    if isinstance(value, list):
+        return _performers(value)
+    if not isinstance(value, dict):
+        return value
+    entry = MappingEntry(value)
+    if 'performers' in entry:
+        entry.performers = _performers(entry.performers)
+    return entry
+
+def plain(value):
+    """Mapping data with records turned back into dicts
+    """
+    if isinstance(value, Record):
+        return {key: plain(item) for key, item in value.to_dict().items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    return value
+
+def json_default(value):
+    """json.dumps default for mapping data, dates are written as YYYY-MM-DD
+    """
+    if isinstance(value, Record):
+        return value.to_dict()
+    return str(value)
+
+def _msgpack_default(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f"can't write {type(value).__name__} to a msgpack mapping")
+
+def _compose(loader, anchors):
+    event = loader.get_event()
+    if isinstance(event, AliasEvent):
+        return anchors[event.anchor]
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+    elif isinstance(event, SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(SequenceEndEvent):
+            node.value.append(_compose(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif isinstance(event, MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(MappingEndEvent):
+            key_node = _compose(loader, anchors)
+            node.value.append((key_node, _compose(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    else:
+        raise yaml.YAMLError(f"unexpected event {event}")
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+def _iter_yaml(filepath, size, progress):
+    with open(filepath, encoding='utf-8') as f:
+        loader = Loader(f)
+        try:
+            # stream start, document start
+            if not loader.check_event(yaml.StreamStartEvent):
+                return
+            loader.get_event()
+            if not loader.check_event(yaml.DocumentStartEvent):
+                return
+            loader.get_event()
+            if not loader.check_event(MappingStartEvent):
+                return
+            loader.get_event()
+            anchors = {}
+            while not loader.check_event(MappingEndEvent):
+                key_node = _compose(loader, anchors)
+                if progress and size:
+                    progress(key_node.start_mark.index / size)
+                key = loader.construct_object(key_node, deep=True)
+                value = loader.construct_object(_compose(loader, anchors), deep=True)
+                loader.constructed_objects = {}
+                yield key, value
+        finally:
+            loader.dispose()
+
+def _iter_jsonl(filepath, size, progress):
+    position = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            if progress and size:
+                progress(position / size)
+            position += len(line)
+            if not line.strip():
+                continue
+            yield from json.loads(line).items()
+
+def _iter_msgpack(filepath, size, progress):
+    _require_msgpack()
+    with open(filepath, 'rb') as f:
+        unpacker = msgpack.Unpacker(f, raw=False, strict_map_key=False)
+        while True:
+            if progress and size:
+                progress(unpacker.tell() / size)
+            try:
+                key, value = unpacker.unpack()
+            except msgpack.OutOfData:
+                return
+            yield key, value
+
+_readers = {
+    'yaml': _iter_yaml,
+    'jsonl': _iter_jsonl,
+    'msgpack': _iter_msgpack,
+}
+
+def iter_mapping(filepath, progress=None):
+    """Yield (filepath, mapdata) entries of a mapping file one at a time without loading the whole file
+    Entries are MappingEntry records, or lists of MappingPerformer for performer only entries
+    progress is called with the fraction of the file read before each entry
+    """
+    if not os.path.isfile(filepath):
+        return
+    size = os.path.getsize(filepath)
+    for key, value in _readers[mapping_format(filepath)](filepath, size, progress):
+        yield key, entry_record(value)
+
+def load_mapping(filepath):
+    return dict(iter_mapping(filepath))
+
+def dump_entry(key, value):
+    return yaml.dump({key: plain(value)}, Dumper=Dumper, default_flow_style=False, width=1000**2)
+
+def dump_jsonl_entry(key, value):
+    return json.dumps({key: value}, default=json_default, ensure_ascii=False) + '\n'
+
+def dump_msgpack_entry(key, value):
+    _require_msgpack()
+    return msgpack.packb([key, value], default=_msgpack_default, use_bin_type=True)
+
+def encode_entry(key, value, format):
+    """A mapping entry as the bytes appended to a mapping file of the format
+    """
+    if format == 'msgpack':
+        return dump_msgpack_entry(key, value)
+    if format == 'jsonl':
+        return dump_jsonl_entry(key, value).encode('utf-8')
+    return dump_entry(key, value).encode('utf-8')
+
+class MappingWriter:
+    """Writes mapping entries to a file as they are produced, in the format of the file extension.
+    Entries go to a temporary file that replaces the output file on close,
+    so the output can be the same file that is being read.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.format = mapping_format(filepath)
+        if self.format == 'msgpack':
+            _require_msgpack()
+        self.tmppath = filepath + '.tmp'
+        dirpath = os.path.dirname(os.path.abspath(filepath))
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        self.count = 0
+        self._file = open(self.tmppath, 'wb')
+
+    def abort(self):
+        if not self._file:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self.tmppath)
+
+    def write(self, key, value):
+        self._file.write(encode_entry(key, value, self.format))
+        self.count += 1
+
+    def close(self):
+        if not self._file:
+            return
+        if not self.count and self.format == 'yaml':
+            self._file.write(b'{}\n')
+        self._file.close()
+        self._file = None
+        os.replace(self.tmppath, self.filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+def save_mapping(filepath, mapping):
+    with MappingWriter(filepath) as writer:
+        for key, value in mapping.items():
+            writer.write(key, value)
+
+def append_mapping(filepath, mapping):
+    """Add entries to the end of a mapping file without rewriting the entries already in it
+    """
+    if not mapping:
+        return
+    format = mapping_format(filepath)
+    if format == 'yaml':
+        # an empty mapping is written as {}, which can't be appended to
+        entries = iter_mapping(filepath)
+        empty = next(entries, None) is None
+        entries.close()
+        if empty:
+            save_mapping(filepath, mapping)
+            return
+    elif not os.path.isfile(filepath):
+        save_mapping(filepath, mapping)
+        return
+    with open(filepath, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        if format != 'msgpack' and f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        for key, value in mapping.items():
+            f.write(encode_entry(key, value, format))
+
+def convert_mapping(infile, outfile, progress=None):
+    """Write the entries of a mapping file to another file in the format of its extension
+    """
+    with MappingWriter(outfile) as writer:
+        for key, value in iter_mapping(infile, progress):
+            writer.write(key, value)
+    return writer.count
@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+from stashlib.logger import logger as log
+from stashlib.stash_interface import StashInterface
+
+"""Batched performer lookups through the stash GraphQL api
+"""
+
+DEFAULT_LOOKUP_BATCH_SIZE = 100
+DEFAULT_LOOKUP_WORKERS = 4
+
+performer_lookup_fields = """
+    performers {
+        id
+        name
+        disambiguation
+        url
+    }"""
+
+def url_variables(url):
+    # same filters as StashInterface.findPerformersByURL
+    return {"q": "", "page": 1, "per_page": 100, "sort": "name", "direction": "ASC"}, {"url": {"value": url, "modifier": "EQUALS"}}
+
+def name_variables(name):
+    # same filters as StashInterface.findPerformersByName
+    return {"q": name, "page": 1, "per_page": 100, "sort": "name", "direction": "ASC"}, {}
+
+def lookup_query(count):
+    """GraphQL document with count aliased findPerformers fields p0..pN, each with its own filter variables
+    """
+    params = ', '.join(f"$f{i}: FindFilterType, $pf{i}: PerformerFilterType" for i in range(count))
+    fields = '\n'.join(f"  p{i}: findPerformers(filter: $f{i}, performer_filter: $pf{i}) {{{performer_lookup_fields}\n  }}" for i in range(count))
+    return f"query({params}) {{\n{fields}\n}}"
+
+def _find_batch(client: StashInterface, batch):
+    variables = {}
+    for i, (kind, value) in enumerate(batch):
+        variables[f"f{i}"], variables[f"pf{i}"] = url_variables(value) if kind == 'url' else name_variables(value[0])
+    result = client.callGraphQL(lookup_query(len(batch)), variables)
+    return [result[f"p{i}"]["performers"] for i in range(len(batch))]
+
+def _match(kind, value, performers):
+    # same matching as StashInterface.findPerformerByURL and findPerformerByName
+    for performer in performers:
+        if kind == 'url' and performer["url"] == value:
+            return performer
+        if kind == 'name' and performer["name"] == value[0] and (performer["disambiguation"] or '') == (value[1] or ''):
+            return performer
+    return None
+
+def find_performers(client: StashInterface, urls=(), names=(), batch_size=DEFAULT_LOOKUP_BATCH_SIZE, workers=DEFAULT_LOOKUP_WORKERS):
+    """Look up performers by url and by (name, disambiguation) with batch_size lookups per request,
+    sending up to workers requests at once.
+    Returns a dict of url to performer and a dict of (name, disambiguation) to performer, None if not found.
+    """
+    lookups = [('url', url) for url in dict.fromkeys(urls)] + [('name', name) for name in dict.fromkeys(names)]
+    by_url = {}
+    by_name = {}
+    if not lookups:
+        return by_url, by_name
+    batch_size = max(1, batch_size or 1)
+    batches = [lookups[i:i + batch_size] for i in range(0, len(lookups), batch_size)]
+    log.LogInfo(f"looking up {len(lookups)} performers in {len(batches)} requests")
+    with ThreadPoolExecutor(max_workers=max(1, workers or 1)) as executor:
+        for batch, results in zip(batches, executor.map(lambda batch: _find_batch(client, batch), batches)):
+            for (kind, value), performers in zip(batch, results):
+                performer = _match(kind, value, performers)
+                if kind == 'url':
+                    by_url[value] = performer
+                else:
+                    by_name[value] = performer
+    return by_url, by_name
@@ -0,0 +1,69 @@
+import time
+from contextlib import nullcontext
+from stashlib.stash_database import StashDatabase
+from stashlib.stash_interface import StashInterface
+from api_backend import ApiBatchWriter, ApiLookupIndex, ApiSceneResolver, DEFAULT_API_WORKERS
+from batch_writer import BatchWriter, ChangePlan, DEFAULT_BATCH_SIZE
+from lookup_index import LookupIndex, DEFAULT_NAME_MATCH_THRESHOLD
+from profiler import profiler as prof
+from scene_resolver import SceneResolver
+from scrape_cache import ScrapeCache
+from scraper import PerformerScraper, DEFAULT_SCRAPE_WORKERS, DEFAULT_SCRAPE_RATE
+from shared_database import SharedStashDatabase
+
+"""Stash lookups shared by processing runs
+"""
+
+class ProcessingContext:
+    """The performer, tag and studio index, scene paths and performer scraper used to process mappings.
+    One context can be passed to several process_mapping calls so the lookups are loaded once
+    and scrape results are reused. Without a database, stash is read and updated through the api.
+    With query_misses, scene paths that weren't loaded are looked up in stash, for scenes added since the load.
+    With a SharedStashDatabase, the index and scene paths are loaded from one snapshot of the database.
+    path_rewrites and match_files are passed to the scene resolver to find scenes whose files moved.
+    With refresh_interval, refresh reloads the index and scene paths once they are older than refresh_interval seconds.
+    """
+
+    def __init__(self, client: StashInterface, db: StashDatabase, preload_index=True, scrape_workers=DEFAULT_SCRAPE_WORKERS, scrape_rate=DEFAULT_SCRAPE_RATE, scrape_cache: ScrapeCache=None,
+            api_workers=DEFAULT_API_WORKERS, name_match_threshold=DEFAULT_NAME_MATCH_THRESHOLD, query_misses=False, refresh_interval=None, path_rewrites=None, match_files=False):
+        self.client = client
+        self.db = db
+        self.preload_index = preload_index
+        self.api_workers = api_workers
+        self.name_match_threshold = name_match_threshold
+        self.query_misses = query_misses
+        self.refresh_interval = refresh_interval
+        self.path_rewrites = path_rewrites
+        self.match_files = match_files
+        if db:
+            prof.instrument_db(db)
+        prof.instrument_client(client)
+        self.scraper = PerformerScraper(client, scrape_workers, scrape_rate, scrape_cache)
+        self.load()
+
+    def load(self):
+        # urls that failed to scrape get another try with each reload
+        self.scraper.retry_failed()
+        if self.db:
+            with self.db.snapshot() if isinstance(self.db, SharedStashDatabase) else nullcontext():
+                with prof.phase('load_index'):
+                    self.index = LookupIndex(self.db, self.preload_index, self.name_match_threshold)
+                with prof.phase('load_scene_paths'):
+                    self.resolver = SceneResolver(self.db, self.preload_index, self.query_misses, self.path_rewrites, self.match_files)
+        else:
+            with prof.phase('load_index'):
+                self.index = ApiLookupIndex(self.client, self.name_match_threshold)
+            with prof.phase('load_scene_paths'):
+                self.resolver = ApiSceneResolver(self.client, self.api_workers, query_misses=self.query_misses, path_rewrites=self.path_rewrites, match_files=self.match_files)
+        self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        """Reload the index and scene paths if they are older than refresh_interval
+        """
+        if self.refresh_interval and time.monotonic() - self.loaded_at >= self.refresh_interval:
+            self.load()
+
+    def writer(self, batch_size=DEFAULT_BATCH_SIZE, on_flush=None, plan: ChangePlan=None):
+        if self.db:
+            return BatchWriter(self.db, batch_size, on_flush, plan)
+        return ApiBatchWriter(self.client, self.resolver, batch_size, on_flush, plan, self.api_workers)
@@ -0,0 +1,226 @@
+import cProfile
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from stashlib.logger import logger as log
+
+"""Phase timers, counters and latency histograms for mapping runs
+"""
+
+# upper bounds of the latency histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+PROGRESS_INTERVAL = 0.5
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * len(HISTOGRAM_BUCKETS)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the pth percentile, capped at the largest value seen
+        """
+        target = self.count * p
+        seen = 0
+        for bound, n in zip(HISTOGRAM_BUCKETS, self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 3) if self.count else None,
+            'min_ms': round(self.min, 3) if self.min is not None else None,
+            'p50_ms': round(self.percentile(0.5), 3) if self.count else None,
+            'p95_ms': round(self.percentile(0.95), 3) if self.count else None,
+            'max_ms': round(self.max, 3) if self.max is not None else None,
+            'buckets': {f"<={bound}ms": n for bound, n in zip(HISTOGRAM_BUCKETS, self.buckets) if n},
+        }
+
+class Profiler:
+    """Collects the time spent in each phase of a run, event counters and latency histograms.
+    The database connection and stash client passed to the mapper are instrumented so every sql statement
+    and graphql call is counted. In plugin mode, progress is sent to stash as the run advances.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cprofile = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.perf_counter()
+            self.phases = {}
+            self.counters = {}
+            self.histograms = {}
+            self._last_progress = None
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if not histogram:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds * 1000)
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += 1
+            phase[1] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    @contextmanager
+    def latency(self, name):
+        """Times a single call into the histogram name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def profiled(self, name):
+        """Decorator timing every call of a function as the phase name
+        """
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iter_phase(self, name, iterable):
+        """Yields from iterable, timing the time spent producing items as the phase name
+        """
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add_phase(name, time.perf_counter() - start)
+                return
+            self.add_phase(name, time.perf_counter() - start)
+            yield item
+
+    def progress(self, fraction):
+        """Send task progress to stash, at most every PROGRESS_INTERVAL seconds
+        """
+        if not log.plugin:
+            return
+        now = time.monotonic()
+        if self._last_progress is not None and now - self._last_progress < PROGRESS_INTERVAL and fraction < 1:
+            return
+        self._last_progress = now
+        log.LogProgress(fraction)
+
+    def instrument_db(self, db):
+        """Count every statement run on the stash database connection
+        """
+        def trace(statement):
+            verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+            if verb == 'SELECT':
+                self.count('db_queries')
+            elif verb in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+                self.count('db_writes')
+            elif verb == 'COMMIT':
+                self.count('db_commits')
+            self.count('db_statements')
+        db.conn.set_trace_callback(trace)
+
+    def instrument_client(self, client):
+        """Count and time every graphql request made by a stash client, by the first field of the query
+        """
+        # clients that aren't a StashInterface, i.e. None or a fake in tests, are left as they are
+        if getattr(client, '_profiled', False) or not hasattr(client, '_StashInterface__callGraphQL'):
+            return
+        call = client._StashInterface__callGraphQL
+        def profiled_call(query, variables=None):
+            # the first field of the query, after its alias if it has one
+            match = re.search(r'{\s*(?:\w+\s*:\s*)?(\w+)', query)
+            operation = match.group(1) if match else 'unknown'
+            self.count('graphql_calls')
+            self.count(f"graphql_calls {operation}")
+            start = time.perf_counter()
+            try:
+                return call(query, variables)
+            finally:
+                self.observe(f"graphql {operation}", time.perf_counter() - start)
+        client._StashInterface__callGraphQL = profiled_call
+        client._profiled = True
+
+    def start_cprofile(self):
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def write_cprofile(self, path):
+        if not self._cprofile:
+            return
+        self._cprofile.disable()
+        self._cprofile.dump_stats(path)
+        self._cprofile = None
+        log.LogInfo(f"cprofile stats written to {path}")
+
+    def summary(self):
+        with self._lock:
+            return {
+                'elapsed': round(time.perf_counter() - self.started, 4),
+                'phases': {name: {'calls': calls, 'seconds': round(seconds, 4)} for name, (calls, seconds) in self.phases.items()},
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"elapsed {summary['elapsed']:.3f}s", '', f"{'phase':<32}{'calls':>10}{'seconds':>12}"]
+        for name, phase in sorted(summary['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"{name:<32}{phase['calls']:>10}{phase['seconds']:>12.3f}")
+        lines += ['', f"{'counter':<32}{'count':>10}"]
+        for name, value in summary['counters'].items():
+            lines.append(f"{name:<32}{value:>10}")
+        lines += ['', f"{'latency':<32}{'count':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for name, histogram in summary['histograms'].items():
+            lines.append(f"{name:<32}{histogram['count']:>10}{histogram['mean_ms']:>10.1f}{histogram['p50_ms']:>10.1f}{histogram['p95_ms']:>10.1f}{histogram['max_ms']:>10.1f}")
+        return '\n'.join(lines)
+
+    def write_summary(self, path):
+        """Write the summary as json if path ends with .json, otherwise as text
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            if path.lower().endswith('.json'):
+                json.dump(self.summary(), f, indent=2)
+            else:
+                f.write(self.format_summary() + '\n')
+        log.LogInfo(f"profile written to {path}")
+
+profiler = Profiler()
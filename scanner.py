@@ -0,0 +1,150 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from stashlib.logger import logger as log
+
+"""Directory scanning for generating mappings
+"""
+
+DEFAULT_EXCLUDE_EXTS = ['.jpg', '.txt', '.json', '.yml', '.yaml', '.jsonl', '.msgpack', '.scan', '.journal', '.tmp']
+
+def parse_exts(exts):
+    """Normalize a comma separated string or list of extensions to a set of lowercase extensions with a leading dot
+    """
+    if not exts:
+        return set()
+    if isinstance(exts, str):
+        exts = exts.split(',')
+    return {('.' + ext.strip().lstrip('.')).lower() for ext in exts if ext.strip()}
+
+class DirectoryScanner:
+    """Lists files in a directory tree with os.scandir, filtered by extension.
+    Subdirectories are scanned in parallel on workers threads, one per cpu by default.
+    With an index path, the mtime of every scanned directory and file is saved to a sidecar json file
+    and the next scan only lists directories whose mtime changed and only yields new or changed files.
+    The sizes from the same stat of the yielded files are kept in file_info until the index is updated.
+    """
+
+    def __init__(self, recursive=False, include_exts=None, exclude_exts=DEFAULT_EXCLUDE_EXTS, workers=None, index_path=None):
+        self.recursive = recursive
+        self.include_exts = parse_exts(include_exts)
+        self.exclude_exts = parse_exts(exclude_exts)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.index_path = index_path
+        self._index = {}
+        self._scanned = {}
+        self._roots = []
+        # path to {'size'} of the files yielded since the last update_index
+        self.file_info = {}
+        if index_path and os.path.isfile(index_path):
+            try:
+                with open(index_path, encoding='utf-8') as f:
+                    index = json.load(f)
+                # a scan with different extension filters has to list every directory again
+                if index.get('filter') == self._filter():
+                    self._index = index['dirs']
+            except (ValueError, KeyError):
+                log.LogWarning(f"ignoring unreadable scan index {index_path}")
+
+    def _filter(self):
+        return [sorted(self.include_exts), sorted(self.exclude_exts)]
+
+    def ext_allowed(self, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        if self.include_exts:
+            return ext in self.include_exts
+        return ext not in self.exclude_exts
+
+    def _scan_dir(self, dirpath):
+        """Returns the index entry of a directory, the paths of its new or changed files and their sizes if they were stat'ed
+        """
+        previous = self._index.get(dirpath)
+        entry = {'mtime': None, 'files': {}, 'dirs': []}
+        changed = []
+        sizes = {}
+        try:
+            mtime = os.stat(dirpath).st_mtime if self.index_path else None
+            if previous and previous['mtime'] == mtime:
+                return previous, [], sizes
+            previous_files = previous['files'] if previous else {}
+            entry['mtime'] = mtime
+            with os.scandir(dirpath) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir():
+                        entry['dirs'].append(dir_entry.name)
+                    elif dir_entry.is_file() and self.ext_allowed(dir_entry.name):
+                        st = dir_entry.stat() if self.index_path else None
+                        file_mtime = st.st_mtime if st else None
+                        entry['files'][dir_entry.name] = file_mtime
+                        # new files aren't in the previous scan, changed files have a different mtime
+                        if dir_entry.name not in previous_files or previous_files[dir_entry.name] != file_mtime:
+                            changed.append(dir_entry.path)
+                            if st:
+                                sizes[dir_entry.path] = {'size': st.st_size}
+        except OSError as e:
+            log.LogWarning(f"error scanning {dirpath}: {e}")
+        changed.sort()
+        return entry, changed, sizes
+
+    def _subdirs(self, dirpath, entry):
+        if not self.recursive:
+            return []
+        return [os.path.join(dirpath, name) for name in sorted(entry['dirs'])]
+
+    def scan(self, dirpath):
+        """Yield the paths of files in dirpath, only new or changed files when the index has a previous scan
+        """
+        self._roots.append(dirpath)
+        if self.workers <= 1:
+            pending = [dirpath]
+            while pending:
+                path = pending.pop(0)
+                entry, changed, sizes = self._scan_dir(path)
+                self._scanned[path] = entry
+                self.file_info.update(sizes)
+                yield from changed
+                pending = self._subdirs(path, entry) + pending
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._scan_dir, dirpath): dirpath}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = futures.pop(future)
+                    entry, changed, sizes = future.result()
+                    self._scanned[path] = entry
+                    self.file_info.update(sizes)
+                    yield from changed
+                    for subdir in self._subdirs(path, entry):
+                        futures[executor.submit(self._scan_dir, subdir)] = subdir
+
+    def update_index(self):
+        """Make the directories scanned since the last update the base of the next scan,
+        dropping directories under the scanned roots that no longer exist
+        """
+        if not self._roots:
+            return
+        prefixes = tuple(os.path.join(root, '') for root in self._roots)
+        index = {path: entry for path, entry in self._index.items()
+            if path not in self._roots and not path.startswith(prefixes)}
+        index.update(self._scanned)
+        self._index = index
+        self._scanned = {}
+        self._roots = []
+        # not cleared in place, generate_mapping may still hold the sizes of this scan
+        self.file_info = {}
+
+    def directories(self):
+        """Paths of the directories in the index
+        """
+        return list(self._index)
+
+    def save_index(self):
+        """Save the directories scanned in this run
+        """
+        if not self.index_path:
+            return
+        self.update_index()
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump({'filter': self._filter(), 'dirs': self._index}, f)
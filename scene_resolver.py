@@ -0,0 +1,267 @@
+import os
+import re
+import struct
+from stashlib.logger import logger as log
+from stashlib.stash_database import StashDatabase
+from mapping_io import Record
+from profiler import profiler as prof
+
+"""Resolution of mapping file paths to stash scene ids
+"""
+
+# bytes read from each end of a file for its oshash
+OSHASH_CHUNK_SIZE = 64 * 1024
+FINGERPRINT_TYPES = ['oshash', 'phash']
+windows_path_re = re.compile(r'^(?:[a-zA-Z]:/|//)')
+
+def normalize_path(filepath):
+    """Normalize separators and, for Windows paths, case so the same file always has the same key
+    """
+    path = filepath.strip().replace('\\', '/')
+    if len(path) > 1:
+        path = path.rstrip('/')
+    if windows_path_re.match(path):
+        path = path.lower()
+    return path
+
+def join_path(dirpath, basename):
+    if dirpath.endswith('/') or dirpath.endswith('\\'):
+        return dirpath + basename
+    return dirpath + '/' + basename
+
+def is_windows_path(filepath):
+    return bool(windows_path_re.match(filepath.strip().replace('\\', '/')))
+
+def path_basename(filepath):
+    """File name of a Windows or posix path
+    """
+    return filepath.strip().replace('\\', '/').rstrip('/').rsplit('/', 1)[-1]
+
+def oshash(filepath):
+    """oshash of a file as stash computes it, the file size plus the sums of the
+    little endian 64 bit words of its first and last 64KB, None for an empty file
+    """
+    size = os.path.getsize(filepath)
+    if not size:
+        return None
+    chunk_size = min(size, OSHASH_CHUNK_SIZE)
+    total = size
+    with open(filepath, 'rb') as f:
+        for offset in (0, size - chunk_size):
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            words = len(chunk) // 8
+            total += sum(struct.unpack(f"<{words}Q", chunk[:words * 8]))
+    return f"{total & 0xFFFFFFFFFFFFFFFF:016x}"
+
+def fingerprint_key(type, value):
+    """Index key of an oshash or phash fingerprint. phashes are stored as signed 64 bit integers
+    in the database and shown as hex strings by the api, so both become unsigned integers.
+    """
+    if value is None or value == '':
+        return None
+    if type == 'phash':
+        try:
+            value = int(value, 16) if isinstance(value, str) else int(value)
+        except ValueError:
+            return None
+        return type, value & 0xFFFFFFFFFFFFFFFF
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    return type, str(value).lower()
+
+def entry_size(mapdata):
+    """File size recorded in a mapping entry, None without one
+    """
+    try:
+        size = int(mapdata.get('size') or 0)
+    except (TypeError, ValueError):
+        return None
+    return size if size > 0 else None
+
+def file_fields(info=None):
+    """size, oshash and phash of a file for its mapping entry from info, read by the directory scan or from a stash export.
+    Empty files get no size.
+    """
+    return {key: value for key, value in (info or {}).items() if value not in (None, '', 0)}
+
+def parse_path_rewrite(rule):
+    """Split an OLD=NEW path prefix rewrite rule
+    """
+    old, sep, new = rule.partition('=')
+    if not sep or not old.strip():
+        raise ValueError(f"path rewrite {rule} isn't OLD=NEW")
+    return old.strip(), new.strip()
+
+class PathRewriter:
+    """Rewrites path prefixes, i.e. from the mount a mapping was generated on to the one stash uses.
+    Rules are (old prefix, new prefix) pairs or OLD=NEW strings and the first matching rule is applied.
+    Prefixes match whole directories, with Windows prefixes matched ignoring case and separators.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = []
+        for rule in rules or []:
+            old, new = parse_path_rewrite(rule) if isinstance(rule, str) else rule
+            self.rules.append((normalize_path(old), new.rstrip('/\\')))
+
+    def rewrite(self, filepath):
+        if not self.rules:
+            return filepath
+        path = filepath.strip().replace('\\', '/')
+        normalized = normalize_path(filepath)
+        for old, new in self.rules:
+            if normalized == old or normalized.startswith(old.rstrip('/') + '/'):
+                rest = path[len(old.rstrip('/')):]
+                # keep the separator style of the new prefix
+                if '\\' in new:
+                    rest = rest.replace('/', '\\')
+                return new + rest
+        return filepath
+
+class SceneResolver:
+    """Maps file paths to the ids of the stash scenes using them.
+    With preload enabled, every scene file path is read in a single query and
+    each lookup is a dictionary hit. Otherwise each lookup is a database query.
+    With query_misses, paths that weren't preloaded are queried, so scenes stash added after the load are found.
+    Paths that aren't found are tried again with path_rewrites applied. With match_files, paths that still
+    aren't found are matched by oshash or phash fingerprint, from the mapping entry or the oshash of the file
+    if it exists where the mapper runs, and then by file name and the size from the entry or the file.
+    File names only match regardless of case when one of the paths is a Windows path. The files of every scene
+    are indexed by fingerprint and by file name and size on the first miss, so each match is a dictionary lookup.
+    """
+
+    def __init__(self, db: StashDatabase, preload=True, query_misses=False, path_rewrites=None, match_files=False):
+        self.db = db
+        self.preload = preload
+        self.query_misses = query_misses
+        self.rewriter = PathRewriter(path_rewrites)
+        self.match_files = match_files
+        self._scene_ids_by_path = {}
+        # lowercased file name and size to the (scene id, file name, Windows path) of each stash file
+        self._files = {}
+        self._fingerprints = {}
+        self._files_loaded = False
+        if preload:
+            self.load()
+
+    def load(self):
+        rows = self.db.fetchall("""SELECT d.path, c.basename, b.scene_id
+FROM scenes_files b
+JOIN files c
+ON c.id = b.file_id
+JOIN folders d
+ON c.parent_folder_id = d.id""")
+        for row in rows:
+            self.add(join_path(row[0], row[1]), row[2])
+        log.LogDebug(f"loaded {len(self._scene_ids_by_path)} scene file paths")
+
+    def load_files(self):
+        """Index the file name, size and fingerprints of every scene file
+        """
+        for row in self.db.fetchall("""SELECT d.path, c.basename, c.size, b.scene_id
+FROM scenes_files b
+JOIN files c
+ON c.id = b.file_id
+JOIN folders d
+ON c.parent_folder_id = d.id"""):
+            self.add_file(row[3], join_path(row[0], row[1]), row[2])
+        params = ', '.join('?' * len(FINGERPRINT_TYPES))
+        for row in self.db.fetchall(f"""SELECT a.type, a.fingerprint, b.scene_id
+FROM files_fingerprints a
+JOIN scenes_files b
+ON b.file_id = a.file_id
+WHERE a.type IN ({params})""", FINGERPRINT_TYPES):
+            self.add_fingerprint(row[2], row[0], row[1])
+        log.LogDebug(f"indexed {len(self._files)} scene file names and sizes and {len(self._fingerprints)} fingerprints")
+
+    def add(self, filepath, scene_id):
+        scene_ids = self._scene_ids_by_path.setdefault(normalize_path(filepath), [])
+        if scene_id not in scene_ids:
+            scene_ids.append(scene_id)
+
+    def add_file(self, scene_id, filepath, size):
+        basename = path_basename(filepath)
+        file = (scene_id, basename, is_windows_path(filepath))
+        files = self._files.setdefault((basename.lower(), size), [])
+        if file not in files:
+            files.append(file)
+
+    def _files_named(self, filepath, size):
+        """Scene ids of the stash files with the name of filepath and size
+        """
+        basename = path_basename(filepath)
+        fold_case = is_windows_path(filepath)
+        files = self._files.get((basename.lower(), size), [])
+        return list(dict.fromkeys(scene_id for scene_id, name, windows in files if fold_case or windows or name == basename))
+
+    def add_fingerprint(self, scene_id, type, value):
+        key = fingerprint_key(type, value)
+        if not key:
+            return
+        scene_ids = self._fingerprints.setdefault(key, [])
+        if scene_id not in scene_ids:
+            scene_ids.append(scene_id)
+
+    def _query(self, filepath):
+        return [scene.id for scene in self.db.get_scenes_from_filepath(filepath)]
+
+    def _scene_ids(self, filepath):
+        if not self.preload:
+            return self._query(filepath)
+        scene_ids = self._scene_ids_by_path.get(normalize_path(filepath))
+        if scene_ids is None and self.query_misses:
+            for scene_id in self._query(filepath):
+                self.add(filepath, scene_id)
+            scene_ids = self._scene_ids_by_path.get(normalize_path(filepath))
+        return scene_ids or []
+
+    def _match_file(self, filepath, rewritten, mapdata):
+        if not self._files_loaded:
+            with prof.phase('load_scene_files'):
+                self.load_files()
+            self._files_loaded = True
+        keys = []
+        size = None
+        if isinstance(mapdata, (dict, Record)):
+            keys += [fingerprint_key(type, mapdata.get(type)) for type in FINGERPRINT_TYPES]
+            size = entry_size(mapdata)
+        # after a move the file usually isn't at the mapping path anymore, the entry's size and fingerprints still match it
+        localpath = next((path for path in dict.fromkeys([filepath, rewritten]) if os.path.isfile(path)), None)
+        if localpath:
+            try:
+                if size is None:
+                    size = os.path.getsize(localpath)
+                keys.append(fingerprint_key('oshash', oshash(localpath)))
+            except OSError as e:
+                log.LogDebug(f"can't read {localpath}: {e}")
+        for key in keys:
+            if key and key in self._fingerprints:
+                prof.count(f"scenes matched by {key[0]}")
+                return self._fingerprints[key]
+        # a file name alone could belong to any scene, it only matches with the size
+        if size is not None:
+            scene_ids = self._files_named(filepath, size)
+            if scene_ids:
+                prof.count('scenes matched by name and size')
+                return scene_ids
+        return []
+
+    def scene_ids(self, filepath, mapdata=None):
+        """Ids of the scenes of a mapping entry, mapdata is the entry for its fingerprints
+        """
+        scene_ids = self._scene_ids(filepath)
+        if scene_ids or not (self.rewriter.rules or self.match_files):
+            return scene_ids
+        rewritten = self.rewriter.rewrite(filepath)
+        if rewritten != filepath:
+            scene_ids = self._scene_ids(rewritten)
+            if scene_ids:
+                prof.count('scenes matched by rewritten path')
+        if not scene_ids and self.match_files:
+            scene_ids = self._match_file(filepath, rewritten, mapdata)
+        # later lookups of the path are a dictionary hit
+        if scene_ids and self.preload:
+            for scene_id in scene_ids:
+                self.add(filepath, scene_id)
+        return scene_ids
@@ -0,0 +1,72 @@
+import json
+import os
+import sqlite3
+import time
+from stashlib.logger import logger as log
+from lookup_index import normalize_url
+from profiler import profiler as prof
+
+"""Persistent cache of scraped performer data
+"""
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scrape_cache.sqlite')
+DEFAULT_CACHE_TTL_DAYS = 30
+DEFAULT_CACHE_MAX_ENTRIES = 100000
+
+class ScrapeCache:
+    """Stores filtered performer scrape results in a local sqlite file, keyed by normalized url.
+    Urls that scraped no data are stored too so they aren't scraped again until the entry expires.
+    Entries older than ttl_days are ignored and the oldest entries are evicted past max_entries.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_days=DEFAULT_CACHE_TTL_DAYS, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl_days * 24 * 60 * 60 if ttl_days and ttl_days > 0 else None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS scrapes (
+url TEXT PRIMARY KEY,
+data TEXT,
+scraped_at REAL NOT NULL)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS index_scrapes_on_scraped_at ON scrapes (scraped_at)""")
+        self.conn.commit()
+
+    def get(self, url):
+        """Returns (True, data) for a cached url, data is None for a url that scraped nothing.
+        Returns (False, None) for a url that isn't cached or has expired.
+        """
+        row = self.conn.execute("""SELECT data, scraped_at FROM scrapes WHERE url = ?""", (normalize_url(url), )).fetchone()
+        if not row or (self.ttl and row[1] < time.time() - self.ttl):
+            self.misses += 1
+            prof.count('scrape_cache_misses')
+            return False, None
+        self.hits += 1
+        prof.count('scrape_cache_hits')
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def put(self, url, data):
+        self.conn.execute("""INSERT OR REPLACE INTO scrapes (url, data, scraped_at) VALUES (?, ?, ?)""",
+            (normalize_url(url), json.dumps(data) if data is not None else None, time.time()))
+        self.conn.commit()
+
+    def evict(self):
+        if self.ttl:
+            self.conn.execute("""DELETE FROM scrapes WHERE scraped_at < ?""", (time.time() - self.ttl, ))
+        if self.max_entries:
+            self.conn.execute("""DELETE FROM scrapes WHERE url IN (SELECT url FROM scrapes ORDER BY scraped_at DESC LIMIT -1 OFFSET ?)""", (self.max_entries, ))
+        self.conn.commit()
+
+    def purge(self):
+        count = self.conn.execute("""SELECT COUNT(*) FROM scrapes""").fetchone()[0]
+        self.conn.execute("""DELETE FROM scrapes""")
+        self.conn.commit()
+        self.conn.execute("""VACUUM""")
+        log.LogInfo(f"purged {count} cached scrapes from {self.path}")
+
+    def close(self):
+        if self.conn:
+            self.evict()
+            self.conn.close()
+            self.conn = None
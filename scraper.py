@@ -0,0 +1,136 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from stashlib.logger import logger as log
+from stashlib.stash_interface import StashInterface
+from profiler import profiler as prof
+from scrape_cache import ScrapeCache
+
+"""Concurrent scraping of performer urls through the stash scrapers
+"""
+
+DEFAULT_SCRAPE_WORKERS = 4
+DEFAULT_SCRAPE_RATE = 1.0
+
+# result of a scrape that raised, unlike None for a url the scrapers found nothing for
+SCRAPE_FAILED = object()
+
+performer_fields = ["name", "url", "gender", "birthdate", "ethnicity",
+            "country", "eye_color", "height", "measurements", "fake_tits",
+            "career_length", "tattoos", "piercings", "aliases", "twitter",
+            "instagram", "favorite", "tag_ids", "image", "stash_ids",
+            "rating", "details", "death_date", "hair_color", "weight"]
+
+def scrape_performer(client: StashInterface, url):
+    """Scrape a performer url and filter the result down to fields accepted by performerCreate
+    """
+    scraped_data = client.scrapePerformerURL(url)
+    log.LogDebug(f"scraped performer: {url}")
+    if not scraped_data:
+        return None
+    if scraped_data.get("images"):
+        scraped_data["image"] = scraped_data["images"][0]
+    for k in list(scraped_data.keys()):
+        if k not in performer_fields:
+            del scraped_data[k]
+    if scraped_data.get("gender"):
+        scraped_data["gender"] = scraped_data["gender"].upper()
+    if scraped_data.get('birthdate') and not re.match(r'\d\d\d\d\-\d\d\-\d\d', scraped_data['birthdate']):
+        del scraped_data['birthdate']
+    if scraped_data.get('death_date') and not re.match(r'\d\d\d\d\-\d\d\-\d\d', scraped_data['death_date']):
+        del scraped_data['death_date']
+    scraped_data.pop('aliases', None)
+    scraped_data.pop('height', None)
+    return scraped_data
+
+def url_host(url):
+    return urlparse(url).netloc.lower()
+
+class HostRateLimiter:
+    """Spaces out requests to the same host so each host sees at most rate requests per second
+    """
+
+    def __init__(self, rate=DEFAULT_SCRAPE_RATE):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self._next_time = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time.get(host, now))
+            self._next_time[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+class PerformerScraper:
+    """Scrapes performer urls on a thread pool, at most once per url.
+    prefetch scrapes a set of urls concurrently ahead of time and scrape returns the stored result,
+    so the sequential create phase doesn't wait on scraper latency.
+    Results found in the scrape cache aren't scraped again.
+    Failed scrapes return SCRAPE_FAILED and aren't cached, they are retried on the next run or after retry_failed.
+    """
+
+    def __init__(self, client: StashInterface, workers=DEFAULT_SCRAPE_WORKERS, rate=DEFAULT_SCRAPE_RATE, cache: ScrapeCache=None):
+        self.client = client
+        self.cache = cache
+        self.workers = max(1, workers or 1)
+        self.limiter = HostRateLimiter(rate)
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _scrape(self, url):
+        self.limiter.wait(url_host(url))
+        prof.count('scrapes')
+        try:
+            with prof.latency('scrape'):
+                return scrape_performer(self.client, url)
+        except Exception as e:
+            prof.count('scrape_failures')
+            log.LogWarning(f"failed to scrape {url}: {e}")
+            return SCRAPE_FAILED
+
+    def _store(self, url, scraped_data):
+        # failed scrapes aren't cached so they are retried on the next run
+        if self.cache and scraped_data is not SCRAPE_FAILED:
+            self.cache.put(url, scraped_data)
+        with self._lock:
+            self._results[url] = scraped_data
+        return scraped_data
+
+    def _cached(self, url):
+        with self._lock:
+            if url in self._results:
+                return True
+        if self.cache:
+            found, scraped_data = self.cache.get(url)
+            if found:
+                with self._lock:
+                    self._results[url] = scraped_data
+                return True
+        return False
+
+    def prefetch(self, urls):
+        urls = [url for url in dict.fromkeys(urls) if url and not self._cached(url)]
+        if not urls:
+            return
+        log.LogInfo(f"scraping {len(urls)} performer urls with {self.workers} workers")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for url, scraped_data in zip(urls, executor.map(self._scrape, urls)):
+                self._store(url, scraped_data)
+
+    def scrape(self, url):
+        if self._cached(url):
+            with self._lock:
+                return self._results[url]
+        return self._store(url, self._scrape(url))
+
+    def retry_failed(self):
+        """Forget failed scrapes so their urls are scraped again
+        """
+        with self._lock:
+            self._results = {url: scraped_data for url, scraped_data in self._results.items() if scraped_data is not SCRAPE_FAILED}
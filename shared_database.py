@@ -0,0 +1,136 @@
+import os
+import pathlib
+import sqlite3
+import time
+from contextlib import contextmanager
+from stashlib.database import regexp, studio_matcher
+from stashlib.logger import logger as log
+from stashlib.stash_database import StashDatabase
+from profiler import profiler as prof
+
+"""Using the stash database while the stash server is running
+"""
+
+# seconds sqlite waits for a lock held by stash before failing with database is locked
+DEFAULT_BUSY_TIMEOUT = 5.0
+# seconds a write transaction stays open before it is committed, so stash can write in between
+DEFAULT_TRANSACTION_TIME = 0.2
+# retries, with exponential backoff, of a write that still found the database locked after busy_timeout
+DEFAULT_LOCK_RETRIES = 5
+LOCK_RETRY_DELAY = 0.5
+
+def is_locked(e):
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+class SharedStashDatabase(StashDatabase):
+    """StashDatabase for use alongside a running stash server.
+    The database is switched to WAL if it isn't already, so reads and writes of the mapper and of stash don't block each other,
+    only writes wait for writes. Bulk reads go through a second, read-only connection, and snapshot keeps a read transaction
+    open on it so everything loaded inside sees the database at the same point in time.
+    Write transactions take the write lock when they begin, waiting up to busy_timeout for stash, and are retried with backoff
+    while stash still holds it. Writes outside of BatchWriter, like creating tags, go through write. BatchWriter commits them every transaction_time seconds so stash never waits long for the mapper.
+    The time spent waiting for locks is added up in lock_wait and recorded as the db_lock_wait phase.
+    """
+
+    def __init__(self, db_path, busy_timeout=DEFAULT_BUSY_TIMEOUT, transaction_time=DEFAULT_TRANSACTION_TIME, lock_retries=DEFAULT_LOCK_RETRIES):
+        super().__init__(db_path, None, None)
+        self.busy_timeout = busy_timeout
+        self.transaction_time = transaction_time
+        self.lock_retries = lock_retries
+        self.lock_wait = 0.0
+        self.conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        self.journal_mode = self._use_wal()
+        self.read_conn = self._connect_read_only(db_path)
+
+    def _use_wal(self):
+        mode = self.conn.execute('PRAGMA journal_mode').fetchone()[0].lower()
+        if mode == 'wal':
+            return mode
+        try:
+            # stash uses WAL itself, switching needs a moment without other connections reading or writing
+            mode = self.conn.execute('PRAGMA journal_mode = WAL').fetchone()[0].lower()
+        except sqlite3.OperationalError as e:
+            log.LogDebug(f"can't switch the stash database to WAL: {e}")
+        if mode == 'wal':
+            log.LogInfo("switched the stash database to WAL")
+        else:
+            log.LogWarning(f"the stash database uses the {mode} journal, stash can't write while the mapper reads and the mapper can't read while stash commits")
+        return mode
+
+    def _connect_read_only(self, db_path):
+        uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.create_function("REGEXP", 2, regexp)
+        conn.create_function("STUDIOMATCHER", 2, studio_matcher)
+        return conn
+
+    def fetchall(self, sql, vals=[]):
+        return self.read_conn.execute(sql, vals).fetchall()
+
+    @contextmanager
+    def snapshot(self):
+        """Read everything fetched inside from one read transaction
+        """
+        self.read_conn.execute('BEGIN')
+        try:
+            yield
+        finally:
+            self.read_conn.execute('COMMIT')
+
+    def _retry_locked(self, fn):
+        """Call fn, retrying with backoff while the database is locked, returns the seconds spent in backoff
+        """
+        slept = 0.0
+        for attempt in range(self.lock_retries + 1):
+            try:
+                fn()
+                return slept
+            except sqlite3.OperationalError as e:
+                if not is_locked(e) or attempt == self.lock_retries:
+                    raise
+                delay = LOCK_RETRY_DELAY * 2 ** attempt
+                log.LogWarning(f"stash database is locked, retrying in {delay}s")
+                prof.count('db_lock_retries')
+                time.sleep(delay)
+                slept += delay
+
+    def _add_lock_wait(self, seconds):
+        self.lock_wait += seconds
+        prof.add_phase('db_lock_wait', seconds)
+        prof.observe('db lock wait', seconds)
+
+    def begin_write(self):
+        """Begin a write transaction, taking the write lock up front
+        """
+        start = time.perf_counter()
+        try:
+            self._retry_locked(lambda: self.conn.execute('BEGIN IMMEDIATE'))
+        finally:
+            self._add_lock_wait(time.perf_counter() - start)
+
+    def commit(self):
+        with prof.latency('db commit'):
+            slept = self._retry_locked(self.conn.commit)
+        if slept:
+            self._add_lock_wait(slept)
+
+    def write(self, fn):
+        """Call fn, which writes without committing, in the open write transaction or in one of its own
+        """
+        if self.conn.in_transaction:
+            return fn()
+        self.begin_write()
+        try:
+            result = fn()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.commit()
+        return result
+
+    def close(self):
+        if self.read_conn:
+            self.read_conn.close()
+            self.read_conn = None
+        super().close()
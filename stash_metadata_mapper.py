@@ -2,9 +2,10 @@ import config
 import sys
 import json
 from stashlib.logger import logger as log
-from stashlib.stash_database import StashDatabase
 from stashlib.stash_interface import StashInterface
 from mapper_gui import generate_gui, process_gui
+from profiler import profiler as prof
+from shared_database import SharedStashDatabase
 
 def read_json_input():
     json_input = sys.stdin.read()
@@ -16,7 +17,8 @@ if __name__ == "__main__":
     client = StashInterface(json_input["server_connection"])
 
     try:
-        db = StashDatabase(config.db_path, None, None)
+        # plugin tasks always run while stash is using the database
+        db = SharedStashDatabase(config.db_path)
     except Exception as e:
         log.LogError(str(e))
         sys.exit(0)
@@ -35,6 +37,11 @@ if __name__ == "__main__":
 
     db.close()
 
+    profile_path = getattr(config, 'profile_path', None)
+    if profile_path:
+        prof.write_summary(profile_path)
+    log.LogDebug(prof.format_summary())
+
     log.LogInfo('done')
     output = {}
     output["output"] = "ok"
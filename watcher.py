@@ -0,0 +1,111 @@
+import os
+import time
+from stashlib.logger import logger as log
+from scanner import DirectoryScanner
+
+"""Watching directories for new files
+"""
+
+# wake on inotify events instead of sleeping between polls when inotify_simple is installed
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_DEBOUNCE = 5.0
+# seconds to wait for inotify events when no files are waiting to settle, so a missed event is still picked up
+IDLE_POLL_INTERVAL = 60.0
+# extensions of files that are still being downloaded
+PARTIAL_EXTS = ['.part', '.crdownload', '.download', '.!qb']
+
+class DirectoryWatcher:
+    """Reports new files under watched roots once they have stopped changing.
+    scanners is a dict of root to the DirectoryScanner with an index used to scan it.
+    Each poll is an incremental scan that only lists directories whose mtime changed,
+    and each new file is held until its size and mtime haven't changed for debounce seconds.
+    Between polls, wait sleeps poll_interval, or with inotify blocks until a watched directory changes.
+    """
+
+    def __init__(self, scanners, poll_interval=DEFAULT_POLL_INTERVAL, debounce=DEFAULT_DEBOUNCE):
+        self.scanners = scanners
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        # file path to (root, size and mtime, time of the last change)
+        self._pending = {}
+        # file path to {'size'} of the settled files poll returned, until they are popped
+        self.file_info = {}
+        self._inotify = None
+        self._watches = {}
+        if INotify:
+            try:
+                self._inotify = INotify()
+            except OSError as e:
+                log.LogWarning(f"inotify unavailable, polling every {poll_interval}s: {e}")
+
+    def _signature(self, filepath):
+        st = os.stat(filepath)
+        return st.st_size, st.st_mtime
+
+    def _watch(self, scanner: DirectoryScanner):
+        if not self._inotify:
+            return
+        mask = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE | flags.DELETE
+        dirpaths = scanner.directories()
+        # the kernel drops the watches of deleted directories, forget them so recreated directories are watched again
+        for dirpath in set(self._watches) - set(dirpaths):
+            del self._watches[dirpath]
+        for dirpath in dirpaths:
+            if dirpath in self._watches:
+                continue
+            try:
+                self._watches[dirpath] = self._inotify.add_watch(dirpath, mask)
+            except OSError as e:
+                # usually the inotify watch limit, polling still finds everything
+                log.LogWarning(f"can't watch {dirpath}, polling every {self.poll_interval}s instead: {e}")
+                self.close()
+                return
+
+    def pending(self, root):
+        return any(pending_root == root for pending_root, signature, changed_at in self._pending.values())
+
+    def poll(self):
+        """Scan the roots and return a dict of root to the paths of new files that have settled
+        """
+        now = time.monotonic()
+        for root, scanner in self.scanners.items():
+            for filepath in scanner.scan(root):
+                if filepath not in self._pending:
+                    self._pending[filepath] = (root, None, now)
+            scanner.update_index()
+            self._watch(scanner)
+
+        ready = {}
+        for filepath, (root, signature, changed_at) in list(self._pending.items()):
+            try:
+                current = self._signature(filepath)
+            except OSError:
+                # removed or renamed before it settled
+                del self._pending[filepath]
+                continue
+            if current != signature:
+                self._pending[filepath] = (root, current, now)
+            elif now - changed_at >= self.debounce:
+                del self._pending[filepath]
+                self.file_info[filepath] = {'size': current[0]}
+                ready.setdefault(root, []).append(filepath)
+        return ready
+
+    def wait(self):
+        if not self._inotify:
+            time.sleep(self.poll_interval)
+            return
+        timeout = self.poll_interval if self._pending else IDLE_POLL_INTERVAL
+        # read_delay gathers the burst of events a single file produces into one wakeup
+        self._inotify.read(timeout=int(timeout * 1000), read_delay=100)
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+            self._watches = {}